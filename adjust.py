@@ -0,0 +1,63 @@
+"""
+Batched brightness/contrast/sharpness adjustment for the 'adjust' pipeline of torchOcr.OCRModel.
+Only needs torch and numpy, unlike imaging.py, so the Lambda image does not need OpenCV.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def _blend(degenerate, image, factor):
+    # Same arithmetic as PIL's Image.blend on uint8 images: degenerate + factor * (image - degenerate),
+    # truncated and clipped to [0, 255]
+    return (degenerate + factor * (image - degenerate)).trunc_().clamp_(0, 255)
+
+
+def _adjust(images, brightness, contrast, sharpness):
+    """
+    Batched equivalent of PIL's ImageEnhance Brightness, Contrast and Sharpness, applied in that order.
+    images is a float (N, 3, H, W) tensor holding uint8 values; factors are (N, 1, 1, 1) tensors.
+    """
+    # Brightness: blend with a black image
+    images = _blend(torch.zeros_like(images), images, brightness)
+
+    # Contrast: blend with the rounded mean of the luma ("L") image, computed like PIL's RGB -> L conversion
+    rgb = images.to(torch.int32)
+    luma = (rgb[:, 0] * 19595 + rgb[:, 1] * 38470 + rgb[:, 2] * 7471 + 0x8000) >> 16
+    mean = (luma.double().mean(dim=(1, 2)) + 0.5).floor().float().view(-1, 1, 1, 1)
+    images = _blend(mean.expand_as(images), images, contrast)
+
+    # Sharpness: blend with ImageFilter.SMOOTH, which keeps the border pixels unchanged
+    kernel = images.new_tensor([[1, 1, 1], [1, 5, 1], [1, 1, 1]]).div_(13).expand(3, 1, 3, 3)
+    smooth = images.clone()
+    if images.shape[2] > 2 and images.shape[3] > 2:
+        smooth[:, :, 1:-1, 1:-1] = F.conv2d(images, kernel, groups=3).add_(0.5).floor_().clamp_(0, 255)
+    return _blend(smooth, images, sharpness)
+
+
+def adjust_batch(images, brightness, contrast, sharpness, size):
+    """
+    Vectorized replacement for OCRModel.adjust_image followed by its resize/ToTensor/Normalize transform.
+    images is a list of (H, W, 3) uint8 RGB arrays, each with its own brightness, contrast and sharpness factor.
+    Images of the same size are enhanced together as one tensor. Returns a normalized (N, 3, *size) tensor.
+    """
+    output = torch.empty((len(images), 3, *size))
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(image.shape, []).append(i)
+
+    for indices in groups.values():
+        batch = torch.from_numpy(np.stack([images[i] for i in indices])).permute(0, 3, 1, 2).float()
+        factors = [
+            torch.tensor([float(values[i]) for i in indices]).view(-1, 1, 1, 1)
+            for values in (brightness, contrast, sharpness)
+        ]
+        batch = _adjust(batch, *factors)
+        # Antialiased bicubic matches PIL's resampling filter. PIL resizes horizontally then vertically and
+        # rounds back to uint8 after each pass, so do the same
+        for pass_size in ((batch.shape[2], size[1]), size):
+            batch = F.interpolate(batch, size=pass_size, mode='bicubic', align_corners=False, antialias=True)
+            batch = batch.round_().clamp_(0, 255)
+        output[indices] = batch.div_(255).sub_(0.5).div_(0.5)
+
+    return output
@@ -0,0 +1,127 @@
+"""
+Admission control in front of the inference path.
+
+Every request admitted to /captchaSolver holds a slot until it has been answered. A request is shed before any
+download or decode when the number of pending requests is at its bound (429), or when the latency a new request
+can expect exceeds the latency budget or the request's own deadline (503). Both carry a Retry-After header.
+
+The expected latency is the time to work through the batches ahead of the request plus its own: the pending
+requests, BATCH_MAX_SIZE per batch, times an EWMA of the duration of one batched forward pass as measured by the
+micro-batcher. The service time excludes queue wait and imgUrl downloads, and the backlog term drains as soon as
+pending requests finish, so the estimate recovers after a busy period without needing admitted traffic.
+"""
+import math
+import os
+import threading
+from contextlib import contextmanager
+
+from batcher import BATCH_MAX_SIZE, add_batch_listener
+
+# Requests admitted at the same time, whether waiting for or running inference
+ADMISSION_MAX_PENDING = int(os.environ.get('ADMISSION_MAX_PENDING', 64))
+# Expected latency above which new requests are shed
+ADMISSION_LATENCY_BUDGET_MS = float(os.environ.get('ADMISSION_LATENCY_BUDGET_MS', 2000))
+# Weight of the latest forward pass in the service time EWMA
+ADMISSION_EWMA_ALPHA = float(os.environ.get('ADMISSION_EWMA_ALPHA', 0.2))
+
+# Request header with the number of milliseconds the client is still willing to wait
+DEADLINE_HEADER = 'X-Deadline-Ms'
+
+
+def parse_deadline(value):
+    """
+    Milliseconds from the deadline header, or None when it is absent. Raises ValueError for anything else.
+    """
+    if value is None or value == '':
+        return None
+    deadline_ms = float(value)
+    if not deadline_ms > 0:
+        raise ValueError(f"{DEADLINE_HEADER} must be a positive number of milliseconds")
+    return deadline_ms
+
+
+class Overloaded(Exception):
+    """
+    Raised instead of admitting a request. status is 429 or 503; retry_after is in whole seconds.
+    """
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_pending=ADMISSION_MAX_PENDING, latency_budget_ms=ADMISSION_LATENCY_BUDGET_MS,
+                 alpha=ADMISSION_EWMA_ALPHA, concurrency=BATCH_MAX_SIZE):
+        self.max_pending = max_pending
+        self.latency_budget = latency_budget_ms / 1000
+        self.alpha = alpha
+        # Requests served together by one batched forward pass
+        self.concurrency = concurrency
+        self.pending = 0
+        # EWMA of the duration of one batched forward pass, see observe_batch()
+        self.service_time = None
+        self.rejected = {429: 0, 503: 0}
+        self._lock = threading.Lock()
+
+    def observe_batch(self, seconds):
+        """
+        Record the duration of one batched forward pass.
+        """
+        with self._lock:
+            if self.service_time is None:
+                self.service_time = seconds
+            else:
+                self.service_time += self.alpha * (seconds - self.service_time)
+
+    def _expected_latency(self):
+        # Requests ahead of this one are served concurrency at a time, one forward pass per batch
+        return self.service_time * (1 + self.pending // self.concurrency)
+
+    def _retry_after(self):
+        drain = self.service_time * math.ceil(self.pending / self.concurrency) if self.service_time else 0
+        return max(1, math.ceil(drain))
+
+    def _reject(self, message, status):
+        self.rejected[status] += 1
+        raise Overloaded(message, status, self._retry_after())
+
+    @contextmanager
+    def admit(self, deadline_ms=None):
+        """
+        Hold a slot for the duration of the block, or raise Overloaded. deadline_ms is the client's remaining budget.
+        """
+        deadline = deadline_ms / 1000 if deadline_ms is not None else None
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self._reject("Too many requests in flight", 429)
+            if self.service_time is not None:
+                expected = self._expected_latency()
+                # An idle service always admits, even when a single forward pass is over budget
+                if self.pending and expected > self.latency_budget:
+                    self._reject("Expected latency exceeds the service budget", 503)
+                if deadline is not None and expected > deadline:
+                    self._reject("The request deadline cannot be met", 503)
+            self.pending += 1
+
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self.pending,
+                "max_pending": self.max_pending,
+                "service_time_ewma_ms": round(self.service_time * 1000, 3) if self.service_time is not None else None,
+                "latency_budget_ms": self.latency_budget * 1000,
+                "rejected_429": self.rejected[429],
+                "rejected_503": self.rejected[503],
+            }
+
+
+admission = AdmissionController()
+add_batch_listener(admission.observe_batch)
@@ -1,91 +1,83 @@
-from flask import Flask, request, jsonify, send_file
-import io
-import json
-import requests
+from flask import Flask, Response, request, jsonify, stream_with_context
+import os
 import base64
-import cgi
-import cv2
-import numpy as np
+from functools import wraps
 from io import BytesIO
 from time import time
-from torchOcr import OCRModel
+from torchOcr import decode_options, get_ocr_model, load_models, prediction_fields
+from fetcher import fetch_image
+from request_params import form_values, load_image_entry, raw_body_params
+from batcher import get_batcher
+from result_cache import make_key, result_cache
+from imaging import preprocess_image
+import metrics
+import profiling
+from multipart import RAW_BODY_MAX_BYTES, parse_multipart, read_body
+from bulk import archive_format_for, iter_archive, solve_archive, to_ndjson
+from admission import DEADLINE_HEADER, Overloaded, admission, parse_deadline
 
 app = Flask(__name__)
 
-def validate_image_url(img_url):
-    response = requests.get(img_url)
-    if response.status_code != 200:
-        raise ValueError("Failed to retrieve image from URL")
-    if response.headers['Content-Type'] not in ['image/jpeg', 'image/jpg', 'image/png']:
-        raise ValueError("Invalid file type")
-    return response.content
-
-def enhance_image(img_buffer, brightness, contrast, sharpness):
-    # Convert image buffer to numpy array
-    print(brightness, contrast, sharpness, "image config")
-    image_np = np.frombuffer(img_buffer.getvalue(), dtype=np.uint8)
-    
-    # Decode the image using OpenCV
-    img = cv2.imdecode(image_np, cv2.IMREAD_UNCHANGED)
-    
-    # Resize image to 200x50
-    img_resized = cv2.resize(img, (200, 50), interpolation=cv2.INTER_AREA)
-    # Convert to grayscale
-    gray = cv2.cvtColor(img_resized, cv2.COLOR_BGR2GRAY)
-    
-    # Apply thresholding (e.g., Otsu's thresholding)
-    _, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    
-    # Track if any enhancement is applied
-    enhancement_applied = True
-
-    # Optionally adjust brightness, contrast, and sharpness
-    if brightness != 1.0 or contrast != 1.0:
-        thresh = cv2.convertScaleAbs(thresh, alpha=contrast, beta=brightness)
-        enhancement_applied = True
-    
-    # Sharpness can be adjusted using a kernel
-    if sharpness != 1.0:
-        kernel = np.array([[-1, -1, -1], [-1, 9 * sharpness, -1], [-1, -1, -1]])
-        thresh = cv2.filter2D(thresh, -1, kernel)
-        enhancement_applied = True
-
-    # Save enhanced image locally if any enhancement was applied
-    if enhancement_applied:
-        output_path = 'enhanced_image.png'  # Local path where the image will be saved
-        cv2.imwrite(output_path, thresh)
-        print(f"Enhanced image saved to {output_path}")
-
-    # Encode the processed image back to a buffer
-    _, buffer = cv2.imencode('.png', thresh)
-    return BytesIO(buffer)
+# Maximum number of images accepted by a single /captchaSolver/batch call
+BATCH_MAX_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', 64))
+
+def admitted(view):
+    # Shed load before any image is downloaded or decoded
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            deadline_ms = parse_deadline(request.headers.get(DEADLINE_HEADER))
+        except ValueError:
+            return jsonify({"error": f"Invalid {DEADLINE_HEADER} header"}), 400
+        try:
+            with admission.admit(deadline_ms):
+                return view(*args, **kwargs)
+        except Overloaded as e:
+            return jsonify({"error": str(e)}), e.status, {"Retry-After": str(e.retry_after)}
+    return wrapper
 
 @app.route('/', methods=['GET'])
 def home():
     return jsonify({"message": "Hello from CaptchaSolver v1.0!"})
 
+@app.route('/cacheStats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(result_cache, admission), mimetype='text/plain; version=0.0.4')
+
 @app.route('/captchaSolver', methods=['POST'])
+@admitted
 def captcha_solver():
     start_time = time()
 
-    ocr_model = OCRModel()
-
     try:
         content_type = request.headers.get('Content-Type', '')
 
         # Initialize variables
-        img_buffer = None
+        img_bytes = None
         img_url = None
 
-        if 'multipart/form-data' in content_type:
-            # Handle file upload via form-data
-            file_item = request.files['file']  # This should match the key name in Postman
-            img_buffer = BytesIO(file_item.read())  # Read the image file content
+        if content_type.startswith('application/octet-stream'):
+            # Raw image body, used as is: no base64 or multipart decoding, read up to RAW_BODY_MAX_BYTES
+            if (request.content_length or 0) > RAW_BODY_MAX_BYTES:
+                raise ValueError("Request body is too large")
+            img_bytes = read_body(request.stream)
+            brightness, contrast, sharpness = raw_body_params(request.headers, request.args)
+            variant, settings = decode_options(request.args)
+
+        elif 'multipart/form-data' in content_type:
+            # Handle file upload via form-data, parsed in one pass from the request stream
+            form_data = parse_multipart(request.stream, content_type)
+            img_bytes = form_data.get('file')  # This should match the key name in Postman
 
             # Retrieve brightness, contrast, and sharpness from form data
-            brightness = float(request.form.get('brightness', 1.0))
-            contrast = float(request.form.get('contrast', 1.0))
-            sharpness = float(request.form.get('sharpness', 1.0))
+            brightness = float(form_data.get('brightness', 1.0))
+            contrast = float(form_data.get('contrast', 1.0))
+            sharpness = float(form_data.get('sharpness', 1.0))
+            variant, settings = decode_options(form_data)
 
         else:
             # Handle JSON input
@@ -95,31 +87,132 @@ def captcha_solver():
             brightness = data.get('brightness', 1.0)
             contrast = data.get('contrast', 1.0)
             sharpness = data.get('sharpness', 1.0)
+            variant, settings = decode_options(data)
 
             if img_url:
-                img_content = validate_image_url(img_url)
-                img_buffer = io.BytesIO(img_content)
+                img_bytes = fetch_image(img_url)
             elif base64_img:
-                img_buffer = BytesIO(base64.b64decode(base64_img))
+                img_bytes = base64.b64decode(base64_img)
 
-        if not img_buffer:
+        if not img_bytes:
             return jsonify({"error": "Either imgUrl, base64Image, or image buffer must be provided"}), 400
 
-        # Enhance image before OCR
-        enhanced_img_buffer = enhance_image(img_buffer, brightness, contrast, sharpness)
-        
-        # Predict using the OCR model
-        detected_text, confidence_score = ocr_model.predict(enhanced_img_buffer)
+        ocr_model = get_ocr_model(variant)
+
+        # Profiled requests always run their own forward pass, bypassing the result cache and the batcher
+        profile = profiling.requested(request.headers.get('X-Profile') or request.args.get('profile'))
+        profile_report = None
+
+        # Repeated images with the same parameters are answered from the result cache
+        cache_key = make_key(img_bytes, brightness, contrast, sharpness, variant, 'enhance', settings)
+        cached = None if profile else result_cache.get(cache_key)
+        if cached:
+            prediction = cached
+        else:
+            # Enhance image before OCR, straight from the request bytes to the model input tensor
+            image = preprocess_image(img_bytes, brightness, contrast, sharpness, ocr_model.img_size)
+
+            if profile:
+                prediction, profile_report = profiling.profile_predict(ocr_model, image, settings)
+            else:
+                # Predict using the OCR model, batched together with concurrent requests
+                prediction = get_batcher(variant).predict(image, settings)
+            result_cache.put(cache_key, prediction)
         result_message = "OCR Completed Successfully."
 
         end_time = time()
         execution_time = end_time - start_time
 
-        return jsonify({
-            "detected_text": detected_text,
-            "confidence_score": confidence_score,
+        response = {
+            **prediction_fields(prediction),
+            "model": variant,
             "result": result_message,
             "execution_time": f"{round(execution_time, 2)} sec",
+        }
+        if profile_report:
+            response["profile"] = profile_report
+        return jsonify(response)
+
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return jsonify({"error": "Internal server error", "details": str(e)}), 500
+
+@app.route('/captchaSolver/batch', methods=['POST'])
+@admitted
+def captcha_solver_batch():
+    start_time = time()
+
+    try:
+        content_type = request.headers.get('Content-Type', '')
+
+        # Each entry is (image buffer or JSON image entry, brightness, contrast, sharpness)
+        entries = []
+
+        if 'multipart/form-data' in content_type:
+            # Handle several file uploads via form-data, optionally with one enhancement value per file
+            form_data = parse_multipart(request.stream, content_type)
+            files = form_data.getlist('file')
+            brightness = form_values(form_data, 'brightness', len(files))
+            contrast = form_values(form_data, 'contrast', len(files))
+            sharpness = form_values(form_data, 'sharpness', len(files))
+            for i, file_content in enumerate(files):
+                entries.append((BytesIO(file_content), brightness[i], contrast[i], sharpness[i]))
+            # The model and decode settings apply to the whole batch
+            variant, settings = decode_options(form_data)
+
+        else:
+            # Handle JSON input: either a list of images or {"images": [...]} with top-level defaults
+            data = request.get_json()
+            if isinstance(data, list):
+                data = {"images": data}
+            for entry in data.get('images') or []:
+                brightness = entry.get('brightness', data.get('brightness', 1.0))
+                contrast = entry.get('contrast', data.get('contrast', 1.0))
+                sharpness = entry.get('sharpness', data.get('sharpness', 1.0))
+                entries.append((entry, brightness, contrast, sharpness))
+            variant, settings = decode_options(data)
+
+        if not entries:
+            return jsonify({"error": "At least one image must be provided"}), 400
+        if len(entries) > BATCH_MAX_IMAGES:
+            return jsonify({"error": f"At most {BATCH_MAX_IMAGES} images can be sent in one batch"}), 400
+
+        ocr_model = get_ocr_model(variant)
+
+        # Load and enhance every image not found in the result cache, keeping per-image errors in place
+        results = [None] * len(entries)
+        images = []
+        for i, (source, brightness, contrast, sharpness) in enumerate(entries):
+            try:
+                img_buffer = source if isinstance(source, BytesIO) else load_image_entry(source)
+                img_bytes = img_buffer.getvalue()
+                cache_key = make_key(img_bytes, brightness, contrast, sharpness, variant, 'enhance', settings)
+                cached = result_cache.get(cache_key)
+                if cached:
+                    results[i] = prediction_fields(cached)
+                    continue
+                image = preprocess_image(img_bytes, brightness, contrast, sharpness, ocr_model.img_size)
+                images.append((i, cache_key, image))
+            except Exception as e:
+                results[i] = {"error": str(e)}
+
+        # Predict all remaining images in a single forward pass
+        if images:
+            predictions = ocr_model.predict_batch([image for _, _, image in images], **settings)
+            for (i, cache_key, _), prediction in zip(images, predictions):
+                result_cache.put(cache_key, prediction)
+                results[i] = prediction_fields(prediction)
+
+        end_time = time()
+        execution_time = end_time - start_time
+
+        return jsonify({
+            "results": results,
+            "model": variant,
+            "result": "OCR Completed Successfully.",
+            "execution_time": f"{round(execution_time, 2)} sec",
         })
 
     except ValueError as ve:
@@ -128,5 +221,28 @@ def captcha_solver():
         print(f"Error: {str(e)}")
         return jsonify({"error": "Internal server error", "details": str(e)}), 500
 
+@app.route('/captchaSolver/bulk', methods=['POST'])
+def captcha_solver_bulk():
+    # Offline backfills: the archive is streamed through the model, so this bypasses admission control,
+    # the micro-batcher and the result cache
+    try:
+        brightness = float(request.args.get('brightness', 1.0))
+        contrast = float(request.args.get('contrast', 1.0))
+        sharpness = float(request.args.get('sharpness', 1.0))
+        variant, settings = decode_options(request.args)
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+
+    archive_format = request.args.get('format') or archive_format_for(request.headers.get('Content-Type', ''))
+    if archive_format not in ('tar', 'zip'):
+        return jsonify({"error": "format must be tar or zip"}), 400
+
+    results = solve_archive(get_ocr_model(variant), iter_archive(request.stream, archive_format),
+                            brightness, contrast, sharpness, settings=settings)
+    return Response(stream_with_context(to_ndjson(results)), mimetype='application/x-ndjson')
+
 if __name__ == '__main__':
+    # Load the models before accepting requests
+    load_models()
+    get_batcher()
     app.run(debug=True)
@@ -0,0 +1,71 @@
+"""
+Self-contained inference artifact for the Lambda cold-start path.
+
+`python artifact.py <output>` builds the inference-only model once, at build time, and saves the whole
+InferenceModel module (PARSeq with its weights, tokenizer and hparams). load_artifact() restores it with a single
+memory-mapped torch.load: no YAML configs, no pretrained weights download and no model construction with random
+initialization that the weights then overwrite.
+
+The artifact is a pickle of the module, so it is tied to the strhub code it was built with and must be rebuilt
+with the image, which the Dockerfile does. Only load artifacts built by this script.
+"""
+import argparse
+import os
+import sys
+
+import torch
+
+ARTIFACT_FORMAT = 2
+# Defaults of the build CLI, the same as torchOcr.MODEL_PATH and torchOcr.MODEL_VARIANT
+DEFAULT_REPO_PATH = '/var/task/torch/hub/baudm_parseq_main'
+DEFAULT_VARIANT = os.environ.get('OCR_MODEL_VARIANTS', 'parseq').split(',')[0].strip()
+
+
+def import_inference(repo_path):
+    """
+    Import strhub.models.parseq.inference from the local parseq hub repository.
+    """
+    if repo_path not in sys.path:
+        sys.path.insert(0, repo_path)
+    from strhub.models.parseq import inference
+    return inference
+
+
+def experiment_name(variant):
+    # hubconf entry points use underscores where the strhub experiment configs use dashes
+    return variant.replace('_', '-')
+
+
+def build_artifact(repo_path, variant, output_path):
+    inference = import_inference(repo_path)
+    model = inference.create_inference_model(experiment_name(variant), pretrained=True)
+    model.hparams.variant = variant
+    model.requires_grad_(False)
+    torch.save({'format': ARTIFACT_FORMAT, 'variant': variant, 'model': model}, output_path)
+
+
+def load_artifact(repo_path, path):
+    """
+    Restore an InferenceModel from an artifact. The weights stay memory-mapped from the file.
+    """
+    # The pickled module refers to the strhub classes, which must be importable
+    import_inference(repo_path)
+    artifact = torch.load(path, map_location='cpu', mmap=True, weights_only=False)
+    if not isinstance(artifact, dict) or artifact.get('format') != ARTIFACT_FORMAT:
+        raise RuntimeError(f"Unsupported artifact format in {path}, rebuild it with artifact.py")
+    return artifact['model'].eval()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the serialized inference artifact')
+    parser.add_argument('output', help='Path of the artifact to write')
+    parser.add_argument('--repo', default=DEFAULT_REPO_PATH, help='Local parseq hub repository')
+    parser.add_argument('--variant', default=DEFAULT_VARIANT, help='hubconf entry point to export')
+    args = parser.parse_args()
+
+    build_artifact(args.repo, args.variant, args.output)
+    print(f"Inference artifact saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
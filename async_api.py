@@ -0,0 +1,202 @@
+import asyncio
+import base64
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from time import time
+
+import aiohttp
+from aiohttp import web
+
+import metrics
+import profiling
+from admission import DEADLINE_HEADER, Overloaded, admission, parse_deadline
+from batcher import get_batcher
+from fetcher import (
+    CHUNK_SIZE, FETCH_BACKOFF, FETCH_CONNECT_TIMEOUT, FETCH_MAX_BYTES, FETCH_POOL_SIZE, FETCH_READ_TIMEOUT,
+    FETCH_RETRIES, RETRY_STATUSES, check_response_headers,
+)
+from imaging import preprocess_image
+from multipart import MULTIPART_MAX_BYTES, RAW_BODY_MAX_BYTES
+from request_params import raw_body_params
+from result_cache import make_key, result_cache
+from torchOcr import decode_options, get_ocr_model, load_models, prediction_fields
+
+# Threads used to decode, enhance and preprocess images off the event loop
+EXECUTOR_WORKERS = int(os.environ.get('ASYNC_EXECUTOR_WORKERS', os.cpu_count() or 1))
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS, thread_name_prefix='ocr-preprocess')
+
+async def fetch_image(session, img_url):
+    """
+    Non-blocking counterpart of fetcher.fetch_image, with the same timeouts, size cap and retries.
+    """
+    with metrics.timed('image_fetch'):
+        return await _fetch_with_retries(session, img_url)
+
+async def _fetch_with_retries(session, img_url):
+    for attempt in range(FETCH_RETRIES + 1):
+        try:
+            async with session.get(img_url) as response:
+                if response.status in RETRY_STATUSES and attempt < FETCH_RETRIES:
+                    await asyncio.sleep(FETCH_BACKOFF * 2 ** attempt)
+                    continue
+                check_response_headers(response.status, response.headers)
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    body += chunk
+                    if len(body) > FETCH_MAX_BYTES:
+                        raise ValueError("Image is too large")
+                return bytes(body)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == FETCH_RETRIES:
+                raise ValueError(f"Failed to retrieve image from URL: {e}") from None
+            await asyncio.sleep(FETCH_BACKOFF * 2 ** attempt)
+        except aiohttp.ClientError as e:
+            raise ValueError(f"Failed to retrieve image from URL: {e}") from None
+
+
+def admitted(handler):
+    # Shed load before any image is downloaded or decoded
+    @wraps(handler)
+    async def wrapper(request):
+        try:
+            deadline_ms = parse_deadline(request.headers.get(DEADLINE_HEADER))
+        except ValueError:
+            return web.json_response({"error": f"Invalid {DEADLINE_HEADER} header"}, status=400)
+        try:
+            with admission.admit(deadline_ms):
+                return await handler(request)
+        except Overloaded as e:
+            return web.json_response({"error": str(e)}, status=e.status, headers={"Retry-After": str(e.retry_after)})
+    return wrapper
+
+async def home(request):
+    return web.json_response({"message": "Hello from CaptchaSolver v1.0!"})
+
+async def cache_stats(request):
+    return web.json_response(result_cache.stats())
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render(result_cache, admission),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+@admitted
+async def captcha_solver(request):
+    start_time = time()
+    loop = asyncio.get_running_loop()
+
+    try:
+        img_bytes = None
+
+        if request.content_type == 'application/octet-stream':
+            # Raw image body, used as is: no base64 or multipart decoding, read up to RAW_BODY_MAX_BYTES
+            if (request.content_length or 0) > RAW_BODY_MAX_BYTES:
+                raise ValueError("Request body is too large")
+            img_bytes = await request.read()
+            if len(img_bytes) > RAW_BODY_MAX_BYTES:
+                raise ValueError("Request body is too large")
+            brightness, contrast, sharpness = raw_body_params(request.headers, request.query)
+            variant, settings = decode_options(request.query)
+
+        elif request.content_type == 'multipart/form-data':
+            # Handle file upload via form-data
+            form = await request.post()
+            file_item = form.get('file')
+            if file_item is not None:
+                img_bytes = file_item.file.read()
+            brightness = float(form.get('brightness', 1.0))
+            contrast = float(form.get('contrast', 1.0))
+            sharpness = float(form.get('sharpness', 1.0))
+            variant, settings = decode_options(form)
+
+        else:
+            # Handle JSON input
+            data = await request.json()
+            img_url = data.get('imgUrl')
+            base64_img = data.get('base64Image')
+            brightness = data.get('brightness', 1.0)
+            contrast = data.get('contrast', 1.0)
+            sharpness = data.get('sharpness', 1.0)
+            variant, settings = decode_options(data)
+
+            if img_url:
+                # The event loop keeps serving other requests while the image downloads
+                img_bytes = await fetch_image(request.app['http_session'], img_url)
+            elif base64_img:
+                img_bytes = base64.b64decode(base64_img)
+
+        if not img_bytes:
+            return web.json_response(
+                {"error": "Either imgUrl, base64Image, or image buffer must be provided"}, status=400
+            )
+
+        # Profiled requests always run their own forward pass, bypassing the result cache and the batcher
+        profile = profiling.requested(request.headers.get('X-Profile') or request.query.get('profile'))
+        profile_report = None
+
+        # Repeated images with the same parameters are answered from the result cache
+        cache_key = make_key(img_bytes, brightness, contrast, sharpness, variant, 'enhance', settings)
+        cached = None if profile else result_cache.get(cache_key)
+        if cached:
+            prediction = cached
+        else:
+            # Decode and enhance in the bounded executor, then wait for the batched inference without blocking the loop
+            image = await loop.run_in_executor(
+                executor, preprocess_image, img_bytes, brightness, contrast, sharpness, get_ocr_model(variant).img_size
+            )
+            if profile:
+                prediction, profile_report = await loop.run_in_executor(
+                    executor, profiling.profile_predict, get_ocr_model(variant), image, settings
+                )
+            else:
+                prediction = await asyncio.wrap_future(get_batcher(variant).submit(image, settings))
+            result_cache.put(cache_key, prediction)
+        result_message = "OCR Completed Successfully."
+
+        end_time = time()
+        execution_time = end_time - start_time
+
+        response = {
+            **prediction_fields(prediction),
+            "model": variant,
+            "result": result_message,
+            "execution_time": f"{round(execution_time, 2)} sec",
+        }
+        if profile_report:
+            response["profile"] = profile_report
+        return web.json_response(response)
+
+    except ValueError as ve:
+        return web.json_response({"error": str(ve)}, status=400)
+    except web.HTTPRequestEntityTooLarge:
+        # Bodies over client_max_size, answered like the Flask and Lambda size limits
+        return web.json_response({"error": "Request body is too large"}, status=400)
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        return web.json_response({"error": "Internal server error", "details": str(e)}, status=500)
+
+async def http_session(app):
+    # One client session (and keep-alive connection pool) shared by all image downloads
+    app['http_session'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=FETCH_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(sock_connect=FETCH_CONNECT_TIMEOUT, sock_read=FETCH_READ_TIMEOUT),
+    )
+    yield
+    await app['http_session'].close()
+
+def create_app():
+    # aiohttp's default client_max_size is 1 MiB; accept what the Flask and Lambda paths accept
+    app = web.Application(client_max_size=max(RAW_BODY_MAX_BYTES, MULTIPART_MAX_BYTES))
+    app.cleanup_ctx.append(http_session)
+    app.router.add_get('/', home)
+    app.router.add_get('/cacheStats', cache_stats)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_post('/captchaSolver', captcha_solver)
+    return app
+
+if __name__ == '__main__':
+    # Load the models before accepting requests
+    load_models()
+    get_batcher()
+    web.run_app(create_app(), port=int(os.environ.get('PORT', 8080)))
@@ -0,0 +1,150 @@
+"""
+CPU thread and replica autotuner: `python autotune.py [--batch-size 8]`
+
+Measures PARSeq forward latency and throughput on this host for every combination of intra-op threads,
+inter-op threads and model replicas (processes running side by side) that fits in the available cores.
+The best configuration is saved to OCR_TUNING_PATH, and OCRModel applies it when it is constructed.
+"""
+import argparse
+import json
+import multiprocessing as mp
+import os
+from time import perf_counter
+
+import torch
+
+TUNING_PATH = os.environ.get('OCR_TUNING_PATH', 'ocr_tuning.json')
+
+# Model shared with the forked replicas, see tune()
+_ocr_model = None
+
+# Tuning already applied to this process, see apply_tuning()
+_applied_tuning = None
+
+
+def load_tuning(path=TUNING_PATH):
+    """
+    Return the saved tuning result, or None if the host has not been tuned.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def apply_tuning(tuning=None):
+    """
+    Apply the saved thread configuration to this process. Returns the tuning that was applied, if any.
+    The thread pools can only be configured once, so later calls return the tuning applied first.
+    """
+    global _applied_tuning
+    if _applied_tuning is not None:
+        return _applied_tuning
+    tuning = tuning or load_tuning()
+    if tuning is None:
+        return None
+    torch.set_num_threads(tuning['intra_op_threads'])
+    try:
+        torch.set_num_interop_threads(tuning['inter_op_threads'])
+    except RuntimeError as e:
+        # Only possible before any inter-op parallel work has started in this process
+        print(f"Could not set inter-op threads: {str(e)}")
+    _applied_tuning = tuning
+    return tuning
+
+
+def candidate_configs(cpu_count):
+    intra = 1
+    while intra <= cpu_count:
+        replicas = 1
+        while intra * replicas <= cpu_count:
+            for inter in (1, 2):
+                yield intra, inter, replicas
+            replicas *= 2
+        intra *= 2
+
+
+def _replica(intra, inter, batch_size, duration, barrier, results):
+    torch.set_num_threads(intra)
+    torch.set_num_interop_threads(inter)
+    images = torch.rand(batch_size, 3, *_ocr_model.img_size)
+    latencies = []
+    with torch.no_grad():
+        _ocr_model.model(images)
+        barrier.wait()
+        end = perf_counter() + duration
+        while perf_counter() < end:
+            start = perf_counter()
+            _ocr_model.model(images)
+            latencies.append(perf_counter() - start)
+    results.put(latencies)
+
+
+def measure(intra, inter, replicas, batch_size, duration):
+    """
+    Run `replicas` forked processes concurrently and return throughput (images/sec) and latency percentiles.
+    """
+    ctx = mp.get_context('fork')
+    barrier = ctx.Barrier(replicas)
+    results = ctx.Queue()
+    processes = [
+        ctx.Process(target=_replica, args=(intra, inter, batch_size, duration, barrier, results))
+        for _ in range(replicas)
+    ]
+    for process in processes:
+        process.start()
+    latencies = sorted(latency for _ in processes for latency in results.get())
+    for process in processes:
+        process.join()
+
+    return {
+        'intra_op_threads': intra,
+        'inter_op_threads': inter,
+        'replicas': replicas,
+        'batch_size': batch_size,
+        'throughput': round(len(latencies) * batch_size / duration, 2),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 2),
+    }
+
+
+def tune(batch_size=1, duration=3.0, max_p99_ms=None, cpu_count=None):
+    """
+    Measure every candidate configuration and return the one with the best throughput within the p99 budget.
+    """
+    global _ocr_model
+    from torchOcr import get_ocr_model
+
+    # Load once and stay single-threaded here; each forked replica sets its own thread counts
+    torch.set_num_threads(1)
+    _ocr_model = get_ocr_model(warmup=False, tune=False)
+
+    cpu_count = cpu_count or os.cpu_count() or 1
+    results = []
+    for intra, inter, replicas in candidate_configs(cpu_count):
+        result = measure(intra, inter, replicas, batch_size, duration)
+        print(json.dumps(result))
+        results.append(result)
+
+    eligible = [r for r in results if max_p99_ms is None or r['p99_ms'] <= max_p99_ms] or results
+    best = max(eligible, key=lambda r: r['throughput'])
+    return dict(best, cpu_count=cpu_count, results=results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Find the best thread and replica configuration for this host')
+    parser.add_argument('--batch-size', type=int, default=1, help='Batch size of the expected load')
+    parser.add_argument('--duration', type=float, default=3.0, help='Seconds to measure each configuration')
+    parser.add_argument('--max-p99-ms', type=float, help='Only consider configurations within this p99 latency')
+    parser.add_argument('--output', default=TUNING_PATH, help='Where to save the result')
+    args = parser.parse_args()
+
+    tuning = tune(args.batch_size, args.duration, args.max_p99_ms)
+    with open(args.output, 'w') as f:
+        json.dump(tuning, f, indent=2)
+    print(f"Best configuration saved to {args.output}: {tuning['intra_op_threads']} intra-op threads, "
+          f"{tuning['inter_op_threads']} inter-op threads, {tuning['replicas']} replicas")
+
+
+if __name__ == '__main__':
+    main()
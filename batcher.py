@@ -0,0 +1,107 @@
+import os
+import queue
+import threading
+from concurrent.futures import Future
+from time import monotonic
+
+from torchOcr import MODEL_VARIANT, get_ocr_model
+
+# Upper bound on the number of images run through the model in one forward pass
+BATCH_MAX_SIZE = int(os.environ.get('OCR_BATCH_MAX_SIZE', 16))
+# How long the first request of a batch waits for others to join it
+BATCH_WINDOW_MS = float(os.environ.get('OCR_BATCH_WINDOW_MS', 5))
+
+# Called with the duration in seconds of every batched forward pass, see add_batch_listener()
+_batch_listeners = []
+
+# Process-wide batchers by model variant, see get_batcher()
+_batchers = {}
+_batchers_pid = None
+_batcher_lock = threading.Lock()
+
+
+class MicroBatcher:
+    """
+    Collects images submitted by concurrent requests and runs them through the model as one batch.
+    A batch is flushed when it reaches max_batch_size or when window_ms has passed since its first image arrived.
+    Images submitted with different decode settings are collected together and run as one forward pass per setting.
+    """
+
+    def __init__(self, ocr_model, max_batch_size=BATCH_MAX_SIZE, window_ms=BATCH_WINDOW_MS):
+        self.ocr_model = ocr_model
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000
+        self._queue = queue.Queue()
+        self.pid = os.getpid()
+        self._worker = threading.Thread(target=self._run, name='ocr-batcher', daemon=True)
+        self._worker.start()
+
+    def submit(self, image, settings=None):
+        """
+        Queue a preprocessed image tensor (C, H, W), with optional per-call decode settings (see decode_options()).
+        The returned future resolves to (detected_text, confidence_score).
+        """
+        future = Future()
+        self._queue.put((image, settings or {}, future))
+        return future
+
+    def predict(self, image, settings=None, timeout=None):
+        return self.submit(image, settings).result(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            groups = {}
+            for image, settings, future in self._collect():
+                if future.set_running_or_notify_cancel():
+                    groups.setdefault(tuple(sorted(settings.items())), []).append((image, future))
+            for settings, batch in groups.items():
+                start = monotonic()
+                try:
+                    results = self.ocr_model.predict_batch([image for image, _ in batch], **dict(settings))
+                    for listener in _batch_listeners:
+                        listener(monotonic() - start)
+                except Exception as e:
+                    for _, future in batch:
+                        future.set_exception(e)
+                else:
+                    for (_, future), result in zip(batch, results):
+                        future.set_result(result)
+
+
+def add_batch_listener(listener):
+    """
+    Call listener(seconds) after every batched forward pass of every batcher, with the time the pass took alone
+    (no queue wait, download or decode).
+    """
+    _batch_listeners.append(listener)
+
+
+def get_batcher(variant=None):
+    """
+    Return the shared MicroBatcher of a model variant for this process, creating it (and loading the model) on
+    first use.
+    """
+    global _batchers_pid
+    variant = variant or MODEL_VARIANT
+    # The worker threads do not survive a fork, so a forked child needs its own batchers
+    if variant not in _batchers or _batchers_pid != os.getpid():
+        with _batcher_lock:
+            if _batchers_pid != os.getpid():
+                _batchers.clear()
+                _batchers_pid = os.getpid()
+            if variant not in _batchers:
+                _batchers[variant] = MicroBatcher(get_ocr_model(variant))
+    return _batchers[variant]
@@ -0,0 +1,182 @@
+"""
+Bulk OCR of an image archive, for offline backfills.
+
+Images are read one member at a time from a tar stream (optionally gzip/bz2/xz compressed) or a zip file,
+enhanced, and run through the model in batches of BULK_BATCH_SIZE. One NDJSON line is produced per image as soon
+as its batch finishes, so memory stays bounded by one batch whatever the archive size. Zip archives keep their
+index at the end, so a zip stream is first spooled to a temporary file (in memory up to BULK_SPOOL_BYTES).
+
+`python bulk.py images.tar > results.ndjson` runs the same pipeline locally; `-` reads the archive from stdin.
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import zipfile
+
+from imaging import preprocess_image
+from torchOcr import decode_options, get_ocr_model, prediction_fields
+
+# Images per forward pass
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', 32))
+# Largest archive member accepted as an image
+BULK_MAX_IMAGE_BYTES = int(os.environ.get('BULK_MAX_IMAGE_BYTES', 5 * 1024 * 1024))
+# Zip streams larger than this are spooled to disk instead of memory
+BULK_SPOOL_BYTES = int(os.environ.get('BULK_SPOOL_BYTES', 32 * 1024 * 1024))
+# Largest zip archive accepted, since it has to be spooled whole before it can be read
+BULK_MAX_ARCHIVE_BYTES = int(os.environ.get('BULK_MAX_ARCHIVE_BYTES', 512 * 1024 * 1024))
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+ZIP_CONTENT_TYPES = ('application/zip', 'application/x-zip-compressed')
+
+
+def _tar_members(stream):
+    # 'r|*' reads the archive strictly sequentially, without seeking, whatever its compression
+    with tarfile.open(fileobj=stream, mode='r|*') as archive:
+        for member in archive:
+            # The TarFile would otherwise keep every TarInfo it has read, growing with the member count
+            archive.members.clear()
+            if not member.isfile():
+                continue
+            if member.size > BULK_MAX_IMAGE_BYTES:
+                yield member.name, ValueError("Image is too large")
+                continue
+            yield member.name, archive.extractfile(member).read()
+
+
+def _zip_members(stream):
+    with tempfile.SpooledTemporaryFile(max_size=BULK_SPOOL_BYTES) as spool:
+        total = 0
+        while True:
+            chunk = stream.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > BULK_MAX_ARCHIVE_BYTES:
+                raise ValueError("Zip archive is too large")
+            spool.write(chunk)
+        spool.seek(0)
+        with zipfile.ZipFile(spool) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+                if info.file_size > BULK_MAX_IMAGE_BYTES:
+                    yield info.filename, ValueError("Image is too large")
+                    continue
+                yield info.filename, archive.read(info)
+
+
+def iter_archive(stream, archive_format='tar'):
+    """
+    Yield (name, image bytes) for every file in a tar or zip archive read from a binary stream.
+    A member that cannot be used is yielded with a ValueError in place of its bytes.
+    """
+    try:
+        if archive_format == 'zip':
+            yield from _zip_members(stream)
+        else:
+            yield from _tar_members(stream)
+    except (tarfile.TarError, zipfile.BadZipFile, EOFError) as e:
+        raise ValueError(f"Invalid {archive_format} archive: {e}") from None
+
+
+def archive_format_for(content_type='', name=''):
+    """
+    'zip' or 'tar', from a Content-Type header or a file name.
+    """
+    if content_type.split(';')[0].strip() in ZIP_CONTENT_TYPES or name.lower().endswith('.zip'):
+        return 'zip'
+    return 'tar'
+
+
+def _predict(ocr_model, pending, settings):
+    images = [image for _, image in pending if not isinstance(image, str)]
+    predictions = iter(ocr_model.predict_batch(images, **settings) if images else [])
+    for name, image in pending:
+        if isinstance(image, str):
+            yield {"name": name, "error": image}
+        else:
+            yield {"name": name, **prediction_fields(next(predictions))}
+
+
+def solve_archive(ocr_model, members, brightness=1.0, contrast=1.0, sharpness=1.0, batch_size=BULK_BATCH_SIZE,
+                  settings=None):
+    """
+    Yield one result dict per (name, image bytes) member: {name, detected_text, confidence_score[, stage]} or
+    {name, error}.
+    Results come out in archive order, a batch at a time. settings are per-call decode settings of the model.
+    """
+    settings = settings or {}
+    # (name, preprocessed image tensor or error message)
+    pending = []
+    for name, content in members:
+        try:
+            if isinstance(content, Exception):
+                raise content
+            pending.append((name, preprocess_image(content, brightness, contrast, sharpness, ocr_model.img_size)))
+        except Exception as e:
+            pending.append((name, str(e)))
+        if len(pending) == batch_size:
+            yield from _predict(ocr_model, pending, settings)
+            pending = []
+    if pending:
+        yield from _predict(ocr_model, pending, settings)
+
+
+def to_ndjson(results):
+    """
+    Serialize results as NDJSON lines. An unreadable archive, or any other failure once the response has started,
+    ends the stream with an {error} line.
+    """
+    try:
+        for result in results:
+            yield json.dumps(result) + '\n'
+    except ValueError as ve:
+        yield json.dumps({"error": str(ve)}) + '\n'
+    except Exception as e:
+        print(f"Error: {str(e)}")
+        yield json.dumps({"error": "Internal server error", "details": str(e)}) + '\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OCR every image of a tar or zip archive, one NDJSON line each')
+    parser.add_argument('archive', help="Archive path, or - to read it from stdin")
+    parser.add_argument('--format', choices=['tar', 'zip'], help='Archive format (default: from the file name)')
+    parser.add_argument('--brightness', type=float, default=1.0)
+    parser.add_argument('--contrast', type=float, default=1.0)
+    parser.add_argument('--sharpness', type=float, default=1.0)
+    parser.add_argument('--batch-size', type=int, default=BULK_BATCH_SIZE)
+    parser.add_argument('--model', help='Model variant (default: the first of OCR_MODEL_VARIANTS)')
+    parser.add_argument('--decode-ar', help='Use AR decoding (true/false)')
+    parser.add_argument('--refine-iters', type=int)
+    parser.add_argument('--max-length', type=int)
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
+    try:
+        variant, settings = decode_options({
+            'model': args.model, 'decodeAr': args.decode_ar,
+            'refineIters': args.refine_iters, 'maxLength': args.max_length,
+        })
+    except ValueError as e:
+        parser.error(str(e))
+
+    archive_format = args.format or archive_format_for(name=args.archive)
+    # Keep stdout for the NDJSON results
+    with contextlib.redirect_stdout(sys.stderr):
+        ocr_model = get_ocr_model(variant, warmup=False)
+    stream = sys.stdin.buffer if args.archive == '-' else open(args.archive, 'rb')
+    with stream:
+        results = solve_archive(ocr_model, iter_archive(stream, archive_format),
+                                args.brightness, args.contrast, args.sharpness, args.batch_size, settings)
+        for line in to_ndjson(results):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Confidence-gated cascade of two models.
+
+Every batch first runs through the fast model (parseq_tiny). Only the images whose sequence confidence, the product
+of the probabilities of all characters and of <eos>, is below CASCADE_THRESHOLD are run again through the slow
+model (parseq, optionally with extra refinement iterations). Each result names the stage that produced it.
+
+Enable it by adding 'cascade' to OCR_MODEL_VARIANTS; requests then select it with "model": "cascade".
+"""
+import os
+
+import torch
+
+import metrics
+from torchOcr import CASCADE_VARIANT, get_ocr_model
+
+# Sequence confidence below which the fast model's answer is re-run through the slow model
+CASCADE_THRESHOLD = float(os.environ.get('CASCADE_THRESHOLD', 0.9))
+CASCADE_FAST_MODEL = os.environ.get('CASCADE_FAST_MODEL', 'parseq_tiny')
+CASCADE_SLOW_MODEL = os.environ.get('CASCADE_SLOW_MODEL', 'parseq')
+# Refinement iterations of the slow model (empty for its default)
+CASCADE_SLOW_REFINE_ITERS = os.environ.get('CASCADE_SLOW_REFINE_ITERS', '')
+
+
+class CascadeModel:
+    """
+    Serves the OCRModel interface; predict_batch() results are (detected_text, confidence_score, stage) tuples,
+    where stage is the variant of the model that produced the answer.
+    """
+
+    def __init__(self, fast_variant=CASCADE_FAST_MODEL, slow_variant=CASCADE_SLOW_MODEL,
+                 threshold=CASCADE_THRESHOLD, slow_refine_iters=CASCADE_SLOW_REFINE_ITERS, tune=True):
+        self.variant = CASCADE_VARIANT
+        self.is_parseq = False
+        self.fast = get_ocr_model(fast_variant, warmup=False, tune=tune)
+        self.slow = get_ocr_model(slow_variant, warmup=False, tune=tune)
+        if self.fast.img_size != self.slow.img_size:
+            raise RuntimeError(f"The cascade stages take different image sizes: {fast_variant} {self.fast.img_size}, "
+                               f"{slow_variant} {self.slow.img_size}")
+        self.img_size = self.fast.img_size
+        self.threshold = threshold
+        self.slow_settings = {'refine_iters': int(slow_refine_iters)} if str(slow_refine_iters) else {}
+        # Both stages, e.g. for share_memory()
+        self.model = torch.nn.ModuleList([self.fast.model, self.slow.model])
+
+    def warmup(self):
+        self.fast.warmup()
+        self.slow.warmup()
+
+    def decode_image(self, image_input):
+        return self.fast.decode_image(image_input)
+
+    def load_images(self, images, brightness, contrast, sharpness):
+        return self.fast.load_images(images, brightness, contrast, sharpness)
+
+    def load_image(self, image_input, brightness=1.0, contrast=1.0, sharpness=1.0):
+        return self.fast.load_image(image_input, brightness, contrast, sharpness)
+
+    def predict_batch(self, images, max_length=None):
+        if isinstance(images, (list, tuple)):
+            images = torch.stack(images)
+
+        fast = self.fast.predict_scores(images, max_length)
+        results = [(label, confidence, self.fast.variant) for label, confidence, _ in fast]
+        retry = [i for i, (_, _, sequence_confidence) in enumerate(fast) if sequence_confidence < self.threshold]
+        if retry:
+            metrics.cascade_escalations.inc(len(retry))
+            slow = self.slow.predict_scores(images[retry], max_length, **self.slow_settings)
+            for i, (label, confidence, _) in zip(retry, slow):
+                results[i] = (label, confidence, self.slow.variant)
+        return results
+
+    def predict(self, image_input, brightness=1.0, contrast=1.0, sharpness=1.0, **settings):
+        image = self.load_image(image_input, brightness, contrast, sharpness)
+        return self.predict_batch(image.unsqueeze(0), **settings)[0]
@@ -0,0 +1,85 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+
+ALLOWED_CONTENT_TYPES = ['image/jpeg', 'image/jpg', 'image/png']
+
+# Seconds to wait for the TCP/TLS connection and then between bytes of the response
+FETCH_CONNECT_TIMEOUT = float(os.environ.get('FETCH_CONNECT_TIMEOUT', 3.05))
+FETCH_READ_TIMEOUT = float(os.environ.get('FETCH_READ_TIMEOUT', 10))
+# Largest image body accepted from an imgUrl
+FETCH_MAX_BYTES = int(os.environ.get('FETCH_MAX_BYTES', 5 * 1024 * 1024))
+# Retries for connection errors and retryable status codes, with exponential backoff between attempts
+FETCH_RETRIES = int(os.environ.get('FETCH_RETRIES', 2))
+FETCH_BACKOFF = float(os.environ.get('FETCH_BACKOFF', 0.2))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Keep-alive connections kept per host
+FETCH_POOL_SIZE = int(os.environ.get('FETCH_POOL_SIZE', 32))
+
+CHUNK_SIZE = 64 * 1024
+
+
+def check_response_headers(status, headers, max_bytes=FETCH_MAX_BYTES):
+    """
+    Reject a response from its status and headers alone, before any of the body is downloaded.
+    """
+    if status != 200:
+        raise ValueError("Failed to retrieve image from URL")
+    content_type = headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type not in ALLOWED_CONTENT_TYPES:
+        raise ValueError("Invalid file type")
+    content_length = headers.get('Content-Length')
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise ValueError("Image is too large")
+
+
+class ImageFetcher:
+    """
+    Downloads imgUrl images over a pooled keep-alive session, with timeouts, retries and a size cap.
+    """
+
+    def __init__(self, connect_timeout=FETCH_CONNECT_TIMEOUT, read_timeout=FETCH_READ_TIMEOUT,
+                 max_bytes=FETCH_MAX_BYTES, retries=FETCH_RETRIES, backoff=FETCH_BACKOFF, pool_size=FETCH_POOL_SIZE):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_bytes = max_bytes
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=['GET'],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, img_url):
+        """
+        Return the image bytes at img_url. Raises ValueError for any download or validation failure.
+        """
+        try:
+            with self.session.get(img_url, stream=True, timeout=self.timeout) as response:
+                check_response_headers(response.status_code, response.headers, self.max_bytes)
+                body = bytearray()
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    body += chunk
+                    if len(body) > self.max_bytes:
+                        raise ValueError("Image is too large")
+                return bytes(body)
+        except requests.RequestException as e:
+            raise ValueError(f"Failed to retrieve image from URL: {e}") from None
+
+
+# Shared by every request in the process so that connections are reused
+_fetcher = ImageFetcher()
+
+
+def fetch_image(img_url):
+    with metrics.timed('image_fetch'):
+        return _fetcher.fetch(img_url)
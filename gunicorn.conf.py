@@ -0,0 +1,47 @@
+"""
+Pre-fork multi-process server for api.py: `gunicorn -c gunicorn.conf.py`
+
+The master loads the model weights once and forks the workers, which share them copy-on-write: inference only
+reads the weights, so their pages are never copied. Each worker pins its own torch thread count and warms up its
+copy of the model after the fork. Gunicorn restarts workers that die.
+"""
+import gc
+import os
+
+import torch
+
+from autotune import apply_tuning, load_tuning
+from torchOcr import load_models
+
+wsgi_app = 'api:app'
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+preload_app = True
+
+# Intra-op threads per worker and number of workers. Defaults come from autotune.py when the host has been tuned,
+# otherwise the cores are split evenly between single-threaded workers
+tuning = load_tuning() or {}
+worker_threads = int(os.environ.get('OCR_WORKER_THREADS', tuning.get('intra_op_threads', 1)))
+workers = int(os.environ.get('OCR_WORKERS', tuning.get('replicas', max(1, (os.cpu_count() or 1) // worker_threads))))
+# Request threads per worker, so that concurrent requests can be micro-batched
+worker_class = 'gthread'
+threads = int(os.environ.get('OCR_WORKER_CONNECTIONS', 16))
+timeout = int(os.environ.get('OCR_WORKER_TIMEOUT', 60))
+
+# Move the weights into shared memory instead of relying on copy-on-write
+share_memory = os.environ.get('OCR_SHARE_MEMORY', '0') == '1'
+
+
+def on_starting(server):
+    # Stay single-threaded in the master so that no OpenMP thread pool exists when the workers are forked
+    torch.set_num_threads(1)
+    for ocr_model in load_models(warmup=False, tune=False):
+        if share_memory:
+            ocr_model.model.share_memory()
+    # Keep the garbage collector from writing to (and so copying) every object page inherited by the workers
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    apply_tuning(dict(tuning, intra_op_threads=worker_threads, inter_op_threads=tuning.get('inter_op_threads', 1)))
+    for ocr_model in load_models(warmup=False, tune=False):
+        ocr_model.warmup()
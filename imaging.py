@@ -0,0 +1,72 @@
+import os
+import random
+import uuid
+
+import cv2
+import numpy as np
+import torch
+
+import metrics
+
+# Model input size as (width, height), matching the img_size of the PARSeq models
+MODEL_INPUT_SIZE = (128, 32)
+
+# Fraction of enhanced images written to ENHANCE_DEBUG_DUMP_DIR for inspection (0 disables the dump)
+DEBUG_DUMP_RATE = float(os.environ.get('ENHANCE_DEBUG_DUMP_RATE', 0))
+DEBUG_DUMP_DIR = os.environ.get('ENHANCE_DEBUG_DUMP_DIR', 'enhanced_images')
+
+
+def enhance_image(image_bytes, brightness, contrast, sharpness, size=MODEL_INPUT_SIZE):
+    """
+    Decode raw image bytes and binarize them at the model input size.
+    Returns a single channel uint8 array of shape (height, width).
+    """
+    # Decode straight to grayscale from the request bytes
+    with metrics.timed('bytes_decode'):
+        img = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise ValueError("Invalid image data")
+
+    with metrics.timed('enhance_image'):
+        # Resize once, directly to the model input size
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+        # Apply thresholding (e.g., Otsu's thresholding)
+        _, thresh = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+        # Optionally adjust brightness, contrast, and sharpness
+        if brightness != 1.0 or contrast != 1.0:
+            thresh = cv2.convertScaleAbs(thresh, alpha=contrast, beta=brightness)
+
+        # Sharpness can be adjusted using a kernel
+        if sharpness != 1.0:
+            kernel = np.array([[-1, -1, -1], [-1, 9 * sharpness, -1], [-1, -1, -1]])
+            thresh = cv2.filter2D(thresh, -1, kernel)
+
+        if DEBUG_DUMP_RATE and random.random() < DEBUG_DUMP_RATE:
+            os.makedirs(DEBUG_DUMP_DIR, exist_ok=True)
+            output_path = os.path.join(DEBUG_DUMP_DIR, f'{uuid.uuid4().hex}.png')
+            cv2.imwrite(output_path, thresh)
+            print(f"Enhanced image saved to {output_path}")
+
+        return thresh
+
+
+def to_model_tensor(image):
+    """
+    Turn a single channel uint8 image into a normalized (3, H, W) model input tensor.
+    """
+    tensor = torch.from_numpy(image).float().div_(255).sub_(0.5).div_(0.5)
+    # The model expects RGB input; all three channels of a grayscale image are identical
+    return tensor.unsqueeze(0).expand(3, -1, -1)
+
+
+def preprocess_image(image_bytes, brightness=1.0, contrast=1.0, sharpness=1.0, img_size=None):
+    """
+    Raw image bytes to model input tensor, entirely in memory.
+    img_size is the (height, width) of the model, as in OCRModel.img_size; MODEL_INPUT_SIZE when not given.
+    """
+    size = MODEL_INPUT_SIZE if img_size is None else (img_size[1], img_size[0])
+    image = enhance_image(image_bytes, brightness, contrast, sharpness, size)
+    with metrics.timed('tensor_preprocess'):
+        return to_model_tensor(image)
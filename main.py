@@ -1,28 +1,208 @@
 import io
+import os
 import json
-import requests
 from io import BytesIO
 from time import time
 import base64
-import cgi
 
-from torchOcr import OCRModel
+import metrics
+import profiling
+from multipart import parse_multipart
+from torchOcr import decode_options, get_ocr_model, load_models, prediction_fields
+from fetcher import fetch_image
+from request_params import form_values, load_image_entry, raw_body_params
+from result_cache import make_key, result_cache
 
-def validate_image_url(img_url):
-    response = requests.get(img_url)
-    if response.status_code != 200:
-        raise ValueError("Failed to retrieve image from URL")
-    if response.headers['Content-Type'] not in ['image/jpeg', 'image/jpg', 'image/png']:
-        raise ValueError("Invalid file type")
-    return response.content
+# Load the models once per container, during the Lambda init phase
+load_models()
+
+# Maximum number of images accepted by a single /captchaSolver/batch call
+BATCH_MAX_IMAGES = int(os.environ.get('BATCH_MAX_IMAGES', 64))
+
+def event_body(event):
+    # API Gateway delivers binary (multipart and octet-stream) bodies base64 encoded
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded', True):
+        return base64.b64decode(body)
+    return body.encode()
+
+def solve_entries(entries, variant=None, settings=None):
+    """
+    OCR a list of (image buffer or JSON image entry, brightness, contrast, sharpness) with one forward pass
+    of the given model variant and decode settings.
+    Returns one {detected_text, confidence_score} or {error} dict per entry, in order.
+    """
+    ocr_model = get_ocr_model(variant)
+    settings = settings or {}
+    # Load and decode every image not found in the result cache, keeping per-image errors in place
+    results = [None] * len(entries)
+    images = []
+    for i, (source, brightness, contrast, sharpness) in enumerate(entries):
+        try:
+            brightness, contrast, sharpness = float(brightness), float(contrast), float(sharpness)
+            img_buffer = source if isinstance(source, BytesIO) else load_image_entry(source)
+            cache_key = make_key(
+                img_buffer.getvalue(), brightness, contrast, sharpness, ocr_model.variant, 'adjust', settings
+            )
+            cached = result_cache.get(cache_key)
+            if cached:
+                results[i] = prediction_fields(cached)
+                continue
+            images.append((i, cache_key, ocr_model.decode_image(img_buffer), brightness, contrast, sharpness))
+        except Exception as e:
+            results[i] = {"error": str(e)}
+
+    # Preprocess and predict all remaining images in a single vectorized pass and a single forward pass
+    if images:
+        _, _, decoded, brightness, contrast, sharpness = zip(*images)
+        batch = ocr_model.load_images(decoded, brightness, contrast, sharpness)
+        predictions = ocr_model.predict_batch(batch, **settings)
+        for (i, cache_key, *_), prediction in zip(images, predictions):
+            result_cache.put(cache_key, prediction)
+            results[i] = prediction_fields(prediction)
+
+    return results
+
+def solve_batch(event, content_type, start_time):
+    # Each entry is (image buffer or JSON image entry, brightness, contrast, sharpness)
+    entries = []
+
+    if 'multipart/form-data' in content_type:
+        # Handle several file uploads via form-data, optionally with one enhancement value per file
+        form_data = parse_multipart(BytesIO(event_body(event)), content_type)
+        files = form_data.getlist('file')
+        brightness = form_values(form_data, 'brightness', len(files))
+        contrast = form_values(form_data, 'contrast', len(files))
+        sharpness = form_values(form_data, 'sharpness', len(files))
+        for i, file_content in enumerate(files):
+            entries.append((BytesIO(file_content), brightness[i], contrast[i], sharpness[i]))
+        # The model and decode settings apply to the whole batch
+        variant, settings = decode_options(form_data)
+    else:
+        # Handle JSON input: either a list of images or {"images": [...]} with top-level defaults
+        body = json.loads(event.get('body') or '{}')
+        if isinstance(body, list):
+            body = {"images": body}
+        for entry in body.get('images') or []:
+            brightness = entry.get('brightness', body.get('brightness', 1.0))
+            contrast = entry.get('contrast', body.get('contrast', 1.0))
+            sharpness = entry.get('sharpness', body.get('sharpness', 1.0))
+            entries.append((entry, brightness, contrast, sharpness))
+        variant, settings = decode_options(body)
+
+    if not entries:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "At least one image must be provided"})
+        }
+    if len(entries) > BATCH_MAX_IMAGES:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": f"At most {BATCH_MAX_IMAGES} images can be sent in one batch"})
+        }
+
+    results = solve_entries(entries, variant, settings)
+
+    end_time = time()
+    execution_time = end_time - start_time
+
+    return {
+        "statusCode": 200,
+        "body": json.dumps({
+            "results": results,
+            "model": variant,
+            "result": "OCR Completed Successfully.",
+            "execution_time": f"{round(execution_time, 2)} sec",
+        })
+    }
+
+def is_job_event(event):
+    # SQS deliveries and direct invocations with a list of jobs, as opposed to API Gateway requests
+    return isinstance(event, list) or 'Records' in event or 'jobs' in event
+
+def solve_jobs(event):
+    """
+    OCR every job of an SQS event ({"Records": [...]}, one JSON image entry per message body) or of a direct
+    invocation (a list of image entries, or {"jobs": [...]}), BATCH_MAX_IMAGES images per forward pass.
+    Returns per-job results and, for SQS partial batch responses, the identifiers of the jobs that failed.
+    """
+    # Each job is (identifier, JSON image entry, or the error that makes it unusable)
+    jobs = []
+    if isinstance(event, dict) and 'Records' in event:
+        for record in event['Records']:
+            try:
+                message_id, body = record['messageId'], json.loads(record['body'])
+            except (KeyError, TypeError, ValueError) as e:
+                jobs.append((record.get('messageId'), ValueError(f"Invalid SQS record: {e}")))
+                continue
+            if isinstance(body, dict):
+                jobs.append((message_id, body))
+            else:
+                jobs.append((message_id, ValueError("Each message body must be a JSON object")))
+    elif isinstance(event, dict) and not isinstance(event['jobs'], list):
+        jobs.append((None, ValueError("jobs must be a list of JSON objects")))
+    else:
+        for i, job in enumerate(event if isinstance(event, list) else event['jobs']):
+            if isinstance(job, dict):
+                jobs.append((job.get('id', str(i)), job))
+            else:
+                jobs.append((str(i), ValueError("Each job must be a JSON object")))
+
+    # Jobs that choose the same model and decode settings share forward passes
+    results = [None] * len(jobs)
+    groups = {}
+    for index, (job_id, job) in enumerate(jobs):
+        try:
+            if isinstance(job, Exception):
+                raise job
+            variant, settings = decode_options(job)
+        except ValueError as e:
+            results[index] = {"id": job_id, "error": str(e)}
+            continue
+        groups.setdefault((variant, tuple(sorted(settings.items()))), []).append(index)
+
+    for (variant, settings), indices in groups.items():
+        for start in range(0, len(indices), BATCH_MAX_IMAGES):
+            chunk = indices[start:start + BATCH_MAX_IMAGES]
+            entries = [
+                (jobs[i][1], jobs[i][1].get('brightness', 1.0), jobs[i][1].get('contrast', 1.0),
+                 jobs[i][1].get('sharpness', 1.0))
+                for i in chunk
+            ]
+            for i, result in zip(chunk, solve_entries(entries, variant, dict(settings))):
+                results[i] = {"id": jobs[i][0], **result}
+
+    return {
+        "results": results,
+        "batchItemFailures": [{"itemIdentifier": result["id"]} for result in results if "error" in result],
+    }
 
 def lambda_handler(event, context):
+    # Log one structured line per request with the time spent in each stage, for CloudWatch metric filters
+    start_time = time()
+    jobs = is_job_event(event)
+    with metrics.request_timings() as timings:
+        response = solve_jobs(event) if jobs else handle_request(event, context)
+    cache = result_cache.stats()
+    if jobs:
+        request_info = {"jobs": len(response['results']), "failed_jobs": len(response['batchItemFailures'])}
+    else:
+        request_info = {"path": event.get('path'), "status": response.get('statusCode')}
+    print(json.dumps({
+        "event": "request_metrics",
+        **request_info,
+        "duration_ms": round((time() - start_time) * 1000, 3),
+        **metrics.snapshot(timings),
+        "cache_hits_total": cache['hits'],
+        "cache_misses_total": cache['misses'],
+    }))
+    return response
+
+def handle_request(event, context):
     http_method = event['httpMethod']
     path = event['path']
     start_time = time()
 
-    ocr_model = OCRModel()
-
     try:
         if http_method == 'GET' and path == '/':
             return {
@@ -38,6 +218,9 @@ def lambda_handler(event, context):
 
         content_type = event['headers'].get('Content-Type', '')
 
+        if path == '/captchaSolver/batch':
+            return solve_batch(event, content_type, start_time)
+
         # Initialize variables
         img_buffer = None
         img_url = None
@@ -45,21 +228,25 @@ def lambda_handler(event, context):
         contrast = 1.0
         sharpness = 1.0
 
-        if 'multipart/form-data' in content_type:
-            # Handle file upload via form-data
-            file_content = base64.b64decode(event['body'])  # Decode the base64 form-data
-            boundary = content_type.split(';')[1].split('=')[1].strip()
-
-            # Parse the form-data
-            environ = {'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': content_type}
-            form_data = cgi.FieldStorage(
-                fp=BytesIO(file_content),
-                environ=environ,
-                keep_blank_values=True
-            )
-            
-            file_item = form_data['file']  # This should match the key name in Postman
-            img_buffer = BytesIO(file_item.file.read())  # Read the image file content
+        if content_type.startswith('application/octet-stream'):
+            # Raw image body: API Gateway delivers binary bodies base64 encoded, with no JSON or multipart around them
+            img_buffer = BytesIO(event_body(event))
+            query = event.get('queryStringParameters') or {}
+            brightness, contrast, sharpness = raw_body_params(event.get('headers') or {}, query)
+            variant, settings = decode_options(query)
+
+        elif 'multipart/form-data' in content_type:
+            # Handle file upload via form-data, parsed in one pass from the decoded body
+            form_data = parse_multipart(BytesIO(event_body(event)), content_type)
+            file_content = form_data.get('file')  # This should match the key name in Postman
+            if file_content:
+                img_buffer = BytesIO(file_content)
+
+            # Retrieve brightness, contrast, and sharpness from form data
+            brightness = float(form_data.get('brightness', 1.0))
+            contrast = float(form_data.get('contrast', 1.0))
+            sharpness = float(form_data.get('sharpness', 1.0))
+            variant, settings = decode_options(form_data)
         else:
             # Handle JSON input
             body = json.loads(event.get('body', '{}'))
@@ -68,9 +255,10 @@ def lambda_handler(event, context):
             brightness = body.get('brightness', 1.0)
             contrast = body.get('contrast', 1.0)
             sharpness = body.get('sharpness', 1.0)
+            variant, settings = decode_options(body)
 
             if img_url:
-                img_content = validate_image_url(img_url)
+                img_content = fetch_image(img_url)
                 img_buffer = io.BytesIO(img_content)
             elif base64_img:
                 img_buffer = BytesIO(base64.b64decode(base64_img))
@@ -82,7 +270,28 @@ def lambda_handler(event, context):
             }
 
         if path == '/captchaSolver' and http_method == 'POST':
-            detected_text, confidenceScore = ocr_model.predict(img_buffer, brightness, contrast, sharpness)
+            # Profiled requests always run their own forward pass, bypassing the result cache
+            query = event.get('queryStringParameters') or {}
+            profile = profiling.requested(
+                event.get('profile') or query.get('profile') or event['headers'].get('X-Profile')
+            )
+            profile_report = None
+
+            # Repeated images with the same parameters are answered from the result cache
+            ocr_model = get_ocr_model(variant)
+            cache_key = make_key(
+                img_buffer.getvalue(), brightness, contrast, sharpness, variant, 'adjust', settings
+            )
+            cached = None if profile else result_cache.get(cache_key)
+            if cached:
+                prediction = cached
+            elif profile:
+                image = ocr_model.load_image(img_buffer, brightness, contrast, sharpness)
+                prediction, profile_report = profiling.profile_predict(ocr_model, image, settings)
+                result_cache.put(cache_key, prediction)
+            else:
+                prediction = ocr_model.predict(img_buffer, brightness, contrast, sharpness, **settings)
+                result_cache.put(cache_key, prediction)
             result_message = "OCR Completed Successfully."
         else:
             return {
@@ -93,14 +302,17 @@ def lambda_handler(event, context):
         end_time = time()
         execution_time = end_time - start_time
 
+        response = {
+            **prediction_fields(prediction),
+            "model": variant,
+            "result": result_message,
+            "execution_time": f"{round(execution_time, 2)} sec",
+        }
+        if profile_report:
+            response["profile"] = profile_report
         return {
             "statusCode": 200,
-            "body": json.dumps({
-                "detected_text": detected_text,
-                "confidence_score": confidenceScore,
-                "result": result_message,
-                "execution_time": f"{round(execution_time, 2)} sec",
-            })
+            "body": json.dumps(response)
         }
 
     except ValueError as ve:
@@ -0,0 +1,211 @@
+"""
+Per-stage latency histograms and counters, exported in the Prometheus text format by /metrics.
+
+Each process keeps its own metrics. Stages are timed with `timed(stage)`; the model stages (ViT encode, AR decode
+steps, refinement) are timed by forward hooks installed with `instrument_model`. Within `request_timings()`, every
+observation is also collected for the current request, which the Lambda path writes out as a structured log.
+"""
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from time import perf_counter
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+STAGES = (
+    'image_fetch', 'bytes_decode', 'enhance_image', 'tensor_preprocess',
+    'vit_encode', 'ar_decode_step', 'nar_decode', 'refinement', 'tokenizer_decode',
+)
+
+# Stage timings of the request being handled in the current context, see request_timings()
+_request_timings = ContextVar('request_timings', default=None)
+# Set while warming up, so that dummy forwards do not show up in the metrics, see paused()
+_paused = ContextVar('metrics_paused', default=False)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels=''):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative = 0
+        for bound, bucket_count in zip(list(self.buckets) + ['+Inf'], counts):
+            cumulative += bucket_count
+            yield f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}'
+        labels = '{' + labels.rstrip(',') + '}' if labels else ''
+        yield f'{name}_sum{labels} {total}'
+        yield f'{name}_count{labels} {count}'
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+stage_seconds = {stage: Histogram(LATENCY_BUCKETS) for stage in STAGES}
+batch_size = Histogram(BATCH_SIZE_BUCKETS)
+early_exits = Counter()
+cascade_escalations = Counter()
+
+
+def observe(stage, seconds):
+    if _paused.get():
+        return
+    stage_seconds[stage].observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, perf_counter() - start)
+
+
+@contextmanager
+def paused():
+    token = _paused.set(True)
+    try:
+        yield
+    finally:
+        _paused.reset(token)
+
+
+@contextmanager
+def request_timings():
+    """
+    Collect the time spent per stage by the current request into the yielded dict.
+    """
+    timings = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def instrument_model(model):
+    """
+    Time the ViT encoder and every decoder call of an InferenceModel, and count AR early exits.
+    Decoder calls are told apart by their shapes: AR steps use a single query position, refinement feeds back
+    a full context, and NAR decoding queries every position from just <bos>. An AR early exit is a forward pass
+    that ran fewer AR steps than its maximum length allows.
+    """
+    parseq = model.model
+    local = threading.local()
+
+    def start(module, args):
+        setattr(local, str(id(module)), perf_counter())
+
+    def encoder_done(module, args, output):
+        observe('vit_encode', perf_counter() - getattr(local, str(id(module))))
+
+    def decoder_done(module, args, output):
+        query, content = args[0], args[1]
+        if query.shape[1] == 1:
+            stage = 'ar_decode_step'
+            local.ar_steps += 1
+        elif content.shape[1] > 1:
+            stage = 'refinement'
+        else:
+            stage = 'nar_decode'
+        observe(stage, perf_counter() - getattr(local, str(id(module))))
+
+    def forward_start(module, args, kwargs):
+        local.ar_steps = 0
+
+    def forward_done(module, args, kwargs, output):
+        max_length = args[2] if len(args) > 2 else kwargs.get('max_length')
+        max_length = module.max_label_length if max_length is None else min(max_length, module.max_label_length)
+        decode_ar = kwargs.get('decode_ar')
+        decode_ar = module.decode_ar if decode_ar is None else decode_ar
+        if decode_ar and not _paused.get() and local.ar_steps < max_length + 1:
+            early_exits.inc()
+
+    parseq.encoder.register_forward_pre_hook(start)
+    parseq.encoder.register_forward_hook(encoder_done)
+    parseq.decoder.register_forward_pre_hook(start)
+    parseq.decoder.register_forward_hook(decoder_done)
+    parseq.register_forward_pre_hook(forward_start, with_kwargs=True)
+    parseq.register_forward_hook(forward_done, with_kwargs=True)
+
+
+def render(result_cache=None, admission=None):
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP ocr_stage_seconds Time spent per request stage.',
+        '# TYPE ocr_stage_seconds histogram',
+    ]
+    for stage, histogram in stage_seconds.items():
+        lines.extend(histogram.samples('ocr_stage_seconds', f'stage="{stage}",'))
+    lines += [
+        '# HELP ocr_batch_size Number of images per model forward pass.',
+        '# TYPE ocr_batch_size histogram',
+        *batch_size.samples('ocr_batch_size'),
+        '# HELP ocr_early_exits_total AR decoding loops that stopped before the maximum length.',
+        '# TYPE ocr_early_exits_total counter',
+        f'ocr_early_exits_total {early_exits.value}',
+        '# HELP ocr_cascade_escalations_total Images re-run through the slow model of the cascade.',
+        '# TYPE ocr_cascade_escalations_total counter',
+        f'ocr_cascade_escalations_total {cascade_escalations.value}',
+    ]
+    if result_cache is not None:
+        stats = result_cache.stats()
+        lines += [
+            '# HELP ocr_cache_hits_total Result cache hits.',
+            '# TYPE ocr_cache_hits_total counter',
+            f'ocr_cache_hits_total {stats["hits"]}',
+            '# HELP ocr_cache_misses_total Result cache misses.',
+            '# TYPE ocr_cache_misses_total counter',
+            f'ocr_cache_misses_total {stats["misses"]}',
+            '# HELP ocr_cache_evictions_total Result cache LRU evictions.',
+            '# TYPE ocr_cache_evictions_total counter',
+            f'ocr_cache_evictions_total {stats["evictions"]}',
+        ]
+    if admission is not None:
+        stats = admission.stats()
+        lines += [
+            '# HELP ocr_admission_pending Requests admitted and not yet answered.',
+            '# TYPE ocr_admission_pending gauge',
+            f'ocr_admission_pending {stats["pending"]}',
+            '# HELP ocr_admission_rejected_total Requests shed by admission control.',
+            '# TYPE ocr_admission_rejected_total counter',
+            f'ocr_admission_rejected_total{{status="429"}} {stats["rejected_429"]}',
+            f'ocr_admission_rejected_total{{status="503"}} {stats["rejected_503"]}',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot(timings):
+    """
+    Structured summary of one request for the Lambda logs.
+    """
+    return {
+        "stages_ms": {stage: round(seconds * 1000, 3) for stage, seconds in timings.items()},
+        "early_exits_total": early_exits.value,
+    }
@@ -0,0 +1,138 @@
+"""
+One-pass multipart/form-data parser shared by the Flask and Lambda request paths.
+
+The body is read from a binary stream in chunks and split on the boundary as it arrives, without the temporary
+files and repeated copies of cgi.FieldStorage (deprecated, and removed in Python 3.13). Parsing stops with a
+ValueError as soon as the body exceeds its size limit.
+"""
+import os
+import re
+
+# Largest multipart body accepted
+MULTIPART_MAX_BYTES = int(os.environ.get('MULTIPART_MAX_BYTES', 10 * 1024 * 1024))
+# Largest raw (application/octet-stream) image body accepted
+RAW_BODY_MAX_BYTES = int(os.environ.get('RAW_BODY_MAX_BYTES', 10 * 1024 * 1024))
+# Largest header line of a part
+MAX_HEADER_LINE = 8 * 1024
+CHUNK_SIZE = 64 * 1024
+
+_PARAM_PATTERN = re.compile(r';\s*([\w*-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;\s]*))')
+
+
+class FormData(dict):
+    """
+    Field name -> list of values. File parts hold bytes, other fields hold str.
+    """
+
+    def getlist(self, name):
+        return list(dict.get(self, name, []))
+
+    def get(self, name, default=None):
+        values = dict.get(self, name)
+        return values[0] if values else default
+
+
+def parse_options(header):
+    """
+    Split a header value such as 'form-data; name="file"' into ('form-data', {'name': 'file'}).
+    """
+    value = header.split(';', 1)[0].strip().lower()
+    options = {}
+    for match in _PARAM_PATTERN.finditer(header):
+        quoted, token = match.group(2), match.group(3)
+        options[match.group(1).lower()] = re.sub(r'\\(.)', r'\1', quoted) if quoted is not None else token
+    return value, options
+
+
+class _Reader:
+    def __init__(self, stream, max_bytes, chunk_size):
+        self.stream = stream
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.total = 0
+
+    def _fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            return False
+        self.total += len(chunk)
+        if self.total > self.max_bytes:
+            raise ValueError("Request body is too large")
+        self.buffer += chunk
+        return True
+
+    def read(self, size):
+        while len(self.buffer) < size and self._fill():
+            pass
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def read_until(self, delimiter, limit=None):
+        """
+        Return everything up to delimiter and consume the delimiter too.
+        """
+        start = 0
+        while True:
+            index = self.buffer.find(delimiter, start)
+            if index >= 0:
+                data = bytes(self.buffer[:index])
+                del self.buffer[:index + len(delimiter)]
+                return data
+            if limit is not None and len(self.buffer) > limit:
+                raise ValueError("Malformed multipart body: header line too long")
+            # The delimiter may straddle the chunk boundary
+            start = max(0, len(self.buffer) - len(delimiter) + 1)
+            if not self._fill():
+                raise ValueError("Malformed multipart body: unexpected end of data")
+
+
+def read_body(stream, max_bytes=RAW_BODY_MAX_BYTES, chunk_size=CHUNK_SIZE):
+    """
+    Read a whole raw body from a binary stream. Raises ValueError as soon as it is larger than max_bytes.
+    """
+    reader = _Reader(stream, max_bytes, chunk_size)
+    while reader._fill():
+        pass
+    return bytes(reader.buffer)
+
+
+def parse_multipart(stream, content_type, max_bytes=MULTIPART_MAX_BYTES, chunk_size=CHUNK_SIZE):
+    """
+    Parse a multipart/form-data body from a binary stream in one pass.
+    Raises ValueError for a missing boundary, a malformed body or a body larger than max_bytes.
+    """
+    _, options = parse_options(content_type)
+    boundary = options.get('boundary')
+    if not boundary:
+        raise ValueError("Missing multipart boundary")
+    delimiter = b'--' + boundary.encode('latin-1')
+
+    form = FormData()
+    reader = _Reader(stream, max_bytes, chunk_size)
+    # Skip the preamble up to the first boundary
+    reader.read_until(delimiter)
+    while True:
+        # '--' right after a boundary closes the body, otherwise the boundary line ends (after optional padding)
+        marker = reader.read(2)
+        if marker == b'--':
+            break
+        if marker != b'\r\n' and (marker + reader.read_until(b'\r\n', MAX_HEADER_LINE)).strip():
+            raise ValueError("Malformed multipart body: invalid boundary line")
+
+        name, filename = None, None
+        while True:
+            line = reader.read_until(b'\r\n', MAX_HEADER_LINE)
+            if not line:
+                break
+            header, _, value = line.decode('latin-1').partition(':')
+            if header.strip().lower() == 'content-disposition':
+                _, disposition = parse_options(value)
+                name, filename = disposition.get('name'), disposition.get('filename')
+
+        body = reader.read_until(b'\r\n' + delimiter)
+        if name is None:
+            continue
+        form.setdefault(name, []).append(body if filename is not None else body.decode('utf-8'))
+    return form
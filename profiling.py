@@ -0,0 +1,105 @@
+"""
+Opt-in torch.profiler breakdown of a single request's inference.
+
+A profiled request runs its own forward pass (outside the result cache and the micro-batcher) and gets back the
+operators that dominated it. The encoder, each DecoderLayer.forward_stream call and tokenizer.decode show up as
+labelled ranges, and a Chrome trace (chrome://tracing, Perfetto) is written to PROFILE_DIR.
+Profiling is off unless PROFILE_ENABLED is set, and only the PROFILE_MAX_TRACES newest traces are kept.
+"""
+import os
+import threading
+import uuid
+from contextlib import contextmanager, nullcontext
+
+from torch.profiler import ProfilerActivity, profile, record_function
+
+# Whether requests may ask for profiling at all. Off by default: a profiled request bypasses the cache and the
+# micro-batcher, serializes on a global lock and writes a trace of several MB
+PROFILE_ENABLED = os.environ.get('PROFILE_ENABLED', '').strip().lower() in ('1', 'true', 'yes', 'on')
+# Where Chrome traces of profiled requests are written
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/ocr-profiles')
+# Number of operators returned in the breakdown
+PROFILE_ROW_LIMIT = int(os.environ.get('PROFILE_ROW_LIMIT', 20))
+# Number of traces kept in PROFILE_DIR, older ones are deleted
+PROFILE_MAX_TRACES = int(os.environ.get('PROFILE_MAX_TRACES', 10))
+
+# The profiler and the labels patched onto the model are process-wide, so only one request is profiled at a time
+_profile_lock = threading.Lock()
+
+
+def requested(value):
+    """
+    Whether a header, query string or event value asks for profiling. Always False unless PROFILE_ENABLED.
+    """
+    if not PROFILE_ENABLED:
+        return False
+    if isinstance(value, bool):
+        return value
+    return str(value or '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _labelled(fn, label):
+    def wrapper(*args, **kwargs):
+        with record_function(label):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def _labels(ocr_model):
+    # Instance attributes shadow the class methods for the duration of the profile only
+    parseq = ocr_model.model.model
+    patched = [(layer, 'forward_stream') for layer in parseq.decoder.layers]
+    patched += [(parseq.encoder, 'forward'), (ocr_model.model.tokenizer, 'decode')]
+    labels = {'forward_stream': 'DecoderLayer.forward_stream', 'forward': 'encoder', 'decode': 'tokenizer.decode'}
+    for obj, name in patched:
+        setattr(obj, name, _labelled(getattr(obj, name), labels[name]))
+    try:
+        yield
+    finally:
+        for obj, name in patched:
+            delattr(obj, name)
+
+
+def _rotate_traces():
+    # Delete all but the PROFILE_MAX_TRACES newest traces, so PROFILE_DIR (e.g. Lambda's /tmp) does not fill up
+    traces = [entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith('.json')]
+    traces.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in traces[max(PROFILE_MAX_TRACES, 1):]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def profile_predict(ocr_model, image, settings=None):
+    """
+    Predict a single preprocessed (C, H, W) image under torch.profiler, with optional per-call decode settings.
+    Returns (prediction, report): prediction as returned by predict_batch(), report the top operators by total CPU
+    time and the path of the Chrome trace.
+    """
+    labels = _labels(ocr_model) if ocr_model.is_parseq else nullcontext()
+    with _profile_lock, labels:
+        with profile(activities=[ProfilerActivity.CPU], record_shapes=True) as prof:
+            with record_function('predict'):
+                result = ocr_model.predict_batch(image.unsqueeze(0), **(settings or {}))[0]
+
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        trace_path = os.path.join(PROFILE_DIR, f'{uuid.uuid4().hex}.json')
+        prof.export_chrome_trace(trace_path)
+        _rotate_traces()
+
+    events = sorted(prof.key_averages(), key=lambda event: event.cpu_time_total, reverse=True)
+    report = {
+        "ops": [
+            {
+                "name": event.key,
+                "calls": event.count,
+                "cpu_time_total_ms": round(event.cpu_time_total / 1000, 3),
+                "self_cpu_time_total_ms": round(event.self_cpu_time_total / 1000, 3),
+            }
+            for event in events[:PROFILE_ROW_LIMIT]
+        ],
+        "trace": trace_path,
+    }
+    return result, report
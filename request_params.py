@@ -0,0 +1,37 @@
+"""
+Request parsing helpers shared by the Flask (api.py), aiohttp (async_api.py) and Lambda (main.py) entry points.
+"""
+import base64
+from io import BytesIO
+
+from fetcher import fetch_image
+
+
+def load_image_entry(entry):
+    """
+    The image of a JSON entry with an imgUrl or a base64Image, as a buffer.
+    """
+    img_url = entry.get('imgUrl')
+    base64_img = entry.get('base64Image')
+    if img_url:
+        return BytesIO(fetch_image(img_url))
+    if base64_img:
+        return BytesIO(base64.b64decode(base64_img))
+    raise ValueError("Either imgUrl or base64Image must be provided")
+
+
+def form_values(form_data, name, count):
+    # A form field can be sent once for all files or once per file
+    values = form_data.getlist(name)
+    if len(values) == 1:
+        values = values * count
+    return [float(value) for value in values] + [1.0] * (count - len(values))
+
+
+def raw_body_params(headers, query):
+    # With an application/octet-stream body, enhancement factors come from X-Brightness, X-Contrast and
+    # X-Sharpness headers or from the query string
+    return [
+        float(headers.get(f'X-{name.capitalize()}', query.get(name, 1.0)))
+        for name in ('brightness', 'contrast', 'sharpness')
+    ]
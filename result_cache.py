@@ -0,0 +1,154 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+# Entries kept in memory (0 disables the cache) and how long an entry stays valid, in seconds
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 10000))
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 3600))
+# Optional SQLite file shared by worker processes and kept across restarts
+RESULT_CACHE_DB = os.environ.get('RESULT_CACHE_DB')
+
+# Expired rows are purged from the on-disk tier once every this many writes
+PURGE_INTERVAL = 1000
+
+
+def make_key(image_bytes, brightness, contrast, sharpness, variant, pipeline, settings=None):
+    """
+    Content address of a request: the image hash plus every parameter that changes the model output.
+    pipeline names the preprocessing the parameters apply to ('enhance' for imaging.py, 'adjust' for OCRModel),
+    settings the per-call decode settings of the model, if any.
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    key = f'{digest}:{float(brightness)!r}:{float(contrast)!r}:{float(sharpness)!r}:{variant}:{pipeline}'
+    if settings:
+        key += ':' + ','.join(f'{name}={value!r}' for name, value in sorted(settings.items()))
+    return key
+
+
+class ResultCache:
+    """
+    LRU cache of (detected_text, confidence_score) with a TTL, optionally backed by an SQLite file.
+    Memory misses fall through to the on-disk tier, and disk hits are promoted back into memory.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, db_path=RESULT_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def _db(self):
+        # SQLite connections cannot be shared across threads or forked processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS results '
+                '(key TEXT PRIMARY KEY, detected_text TEXT NOT NULL, confidence_score REAL NOT NULL, '
+                'expires_at REAL NOT NULL)'
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return self._local.conn
+
+    def _get_disk(self, key, now):
+        try:
+            row = self._db().execute(
+                'SELECT detected_text, confidence_score, expires_at FROM results WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Result cache error: {str(e)}")
+            return None
+        if row is None or row[2] <= now:
+            return None
+        return (row[0], row[1]), row[2]
+
+    def _put_disk(self, key, value, expires_at):
+        try:
+            db = self._db()
+            db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)', (key, value[0], value[1], expires_at))
+            self._writes += 1
+            if self._writes % PURGE_INTERVAL == 0:
+                db.execute('DELETE FROM results WHERE expires_at <= ?', (time(),))
+        except sqlite3.Error as e:
+            print(f"Result cache error: {str(e)}")
+
+    def _put_memory(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key):
+        """
+        Return the cached (detected_text, confidence_score) for key, or None.
+        """
+        if not self.enabled:
+            return None
+        now = time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                del self._entries[key]
+                self.expirations += 1
+
+        if self.db_path:
+            entry = self._get_disk(key, now)
+            if entry is not None:
+                self._put_memory(key, *entry)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return entry[0]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        value = tuple(value)
+        expires_at = time() + self.ttl
+        self._put_memory(key, value, expires_at)
+        if self.db_path:
+            self._put_disk(key, value, expires_at)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+# Shared by every request in the process
+result_cache = ResultCache()
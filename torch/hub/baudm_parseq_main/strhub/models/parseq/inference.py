@@ -0,0 +1,100 @@
+# Scene Text Recognition Model Hub
+# Copyright 2022 Darwin Bautista
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Inference-only PARSeq.
+
+Unlike `strhub.models.parseq.system`, nothing here imports pytorch_lightning, nltk or the optimizer stack.
+"""
+
+from types import SimpleNamespace
+from typing import Any, Optional
+
+from torch import Tensor, nn
+
+from strhub.data.utils import Tokenizer
+from strhub.models.utils import InvalidModelError, _get_config, get_pretrained_weights
+
+from .model import PARSeq
+
+# Constructor arguments of PARSeq, besides num_tokens
+MODEL_ARGS = (
+    'max_label_length',
+    'img_size',
+    'patch_size',
+    'embed_dim',
+    'enc_num_heads',
+    'enc_mlp_ratio',
+    'enc_depth',
+    'dec_num_heads',
+    'dec_mlp_ratio',
+    'dec_depth',
+    'decode_ar',
+    'refine_iters',
+    'dropout',
+)
+
+
+class InferenceModel(nn.Module):
+    """The plain PARSeq module bundled with its tokenizer.
+
+    Exposes the same inference interface as the LightningModule: `forward(images, max_length)`, `tokenizer`
+    and `hparams`.
+    """
+
+    def __init__(self, model: PARSeq, tokenizer: Tokenizer, hparams: dict[str, Any]) -> None:
+        super().__init__()
+        self.model = model
+        self.tokenizer = tokenizer
+        self.hparams = SimpleNamespace(**hparams)
+
+    def forward(
+        self,
+        images: Tensor,
+        max_length: Optional[int] = None,
+        decode_ar: Optional[bool] = None,
+        refine_iters: Optional[int] = None,
+    ) -> Tensor:
+        return self.model(self.tokenizer, images, max_length, decode_ar=decode_ar, refine_iters=refine_iters)
+
+
+def build_inference_model(charset: str, config: dict[str, Any], **hparams: Any) -> InferenceModel:
+    """Build an untrained InferenceModel from the charset and the PARSeq constructor arguments in `config`."""
+    tokenizer = Tokenizer(charset)
+    model = PARSeq(len(tokenizer), **{name: config[name] for name in MODEL_ARGS})
+    hparams = dict(config, charset_train=charset, **hparams)
+    return InferenceModel(model, tokenizer, hparams)
+
+
+def create_inference_model(experiment: str, pretrained: bool = False, **kwargs: Any) -> InferenceModel:
+    """Inference-only counterpart of `strhub.models.utils.create_model` for the PARSeq experiments.
+
+    Args:
+        experiment: PARSeq experiment name, e.g. 'parseq' or 'parseq-tiny'
+        pretrained: load the pretrained weights
+        **kwargs: config overrides, e.g. decode_ar or refine_iters
+
+    Returns:
+        The model in eval mode.
+    """
+    if 'parseq' not in experiment:
+        raise InvalidModelError(f"No inference-only model for '{experiment}'")
+    try:
+        config = _get_config(experiment, **kwargs)
+    except FileNotFoundError:
+        raise InvalidModelError(f"No configuration found for '{experiment}'") from None
+    model = build_inference_model(config['charset_train'], config, experiment=experiment)
+    if pretrained:
+        model.model.load_state_dict(get_pretrained_weights(experiment))
+    return model.eval()
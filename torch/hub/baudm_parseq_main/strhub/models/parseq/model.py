@@ -14,7 +14,7 @@
 # limitations under the License.
 
 from functools import partial
-from typing import Optional, Sequence
+from typing import List, Optional, Sequence, Tuple
 
 import torch
 import torch.nn as nn
@@ -25,7 +25,7 @@ from timm.models.helpers import named_apply
 from strhub.data.utils import Tokenizer
 from strhub.models.utils import init_weights
 
-from .modules import Decoder, DecoderLayer, Encoder, TokenEmbedding
+from .modules import Decoder, DecoderLayer, Encoder, KVCache, TokenEmbedding
 
 
 class PARSeq(nn.Module):
@@ -91,24 +91,56 @@ class PARSeq(nn.Module):
         tgt_padding_mask: Optional[Tensor] = None,
         tgt_query: Optional[Tensor] = None,
         tgt_query_mask: Optional[Tensor] = None,
+        kv_cache: Optional[KVCache] = None,
+        memory_kv: Optional[List[Tuple[Tensor, Tensor]]] = None,
     ):
+        """With kv_cache, tgt holds only the tokens after the cached positions, see KVCache.
+        memory_kv optionally holds the projections of memory from Decoder.memory_kv(), used instead of memory."""
         N, L = tgt.shape
-        # <bos> stands for the null context. We only supply position information for characters after <bos>.
-        null_ctx = self.text_embed(tgt[:, :1])
-        tgt_emb = self.pos_queries[:, : L - 1] + self.text_embed(tgt[:, 1:])
-        tgt_emb = self.dropout(torch.cat([null_ctx, tgt_emb], dim=1))
+        start = 0 if kv_cache is None else kv_cache.length
+        if start == 0:
+            # <bos> stands for the null context. We only supply position information for characters after <bos>.
+            null_ctx = self.text_embed(tgt[:, :1])
+            tgt_emb = self.pos_queries[:, : L - 1] + self.text_embed(tgt[:, 1:])
+            tgt_emb = self.dropout(torch.cat([null_ctx, tgt_emb], dim=1))
+        else:
+            tgt_emb = self.dropout(self.pos_queries[:, start - 1 : start + L - 1] + self.text_embed(tgt))
         if tgt_query is None:
-            tgt_query = self.pos_queries[:, :L].expand(N, -1, -1)
+            tgt_query = self.pos_queries[:, start : start + L].expand(N, -1, -1)
         tgt_query = self.dropout(tgt_query)
-        return self.decoder(tgt_query, tgt_emb, memory, tgt_query_mask, tgt_mask, tgt_padding_mask)
+        return self.decoder(tgt_query, tgt_emb, memory, tgt_query_mask, tgt_mask, tgt_padding_mask, kv_cache, memory_kv)
 
-    def forward(self, tokenizer: Tokenizer, images: Tensor, max_length: Optional[int] = None) -> Tensor:
+    def forward(
+        self,
+        tokenizer: Tokenizer,
+        images: Tensor,
+        max_length: Optional[int] = None,
+        decode_ar: Optional[bool] = None,
+        refine_iters: Optional[int] = None,
+    ) -> Tensor:
+        """Inference
+
+        Args:
+            tokenizer: Tokenizer of the model
+            images: Batch of images. Shape: N, Ch, H, W
+            max_length: Max sequence length of the output. If None, will use default.
+            decode_ar: Use AR decoding for this call only. If None, will use default.
+            refine_iters: Number of refinement iterations for this call only. If None, will use default.
+
+        Returns:
+            logits: N, L, C (L = sequence length, C = number of classes, typically len(charset_train) + 1)
+        """
+        # The per-call settings are plain locals, so concurrent calls with different settings do not interfere
+        decode_ar = self.decode_ar if decode_ar is None else decode_ar
+        refine_iters = self.refine_iters if refine_iters is None else refine_iters
         testing = max_length is None
         max_length = self.max_label_length if max_length is None else min(max_length, self.max_label_length)
         bs = images.shape[0]
         # +1 for <eos> at end of sequence.
         num_steps = max_length + 1
         memory = self.encode(images)
+        # Every decoder call below attends to the same memory, so its projections are computed only once
+        memory_kv = self.decoder.memory_kv(memory)
 
         # Query positions up to `num_steps`
         pos_queries = self.pos_queries[:, :num_steps].expand(bs, -1, -1)
@@ -116,53 +148,79 @@ class PARSeq(nn.Module):
         # Special case for the forward permutation. Faster than using `generate_attn_masks()`
         tgt_mask = query_mask = torch.triu(torch.ones((num_steps, num_steps), dtype=torch.bool, device=self._device), 1)
 
-        if self.decode_ar:
+        if decode_ar:
             tgt_in = torch.full((bs, num_steps), tokenizer.pad_id, dtype=torch.long, device=self._device)
             tgt_in[:, 0] = tokenizer.bos_id
 
+            kv_cache = self.decoder.kv_cache(bs, num_steps, memory)
+            # Rows still being decoded, and the decoder state of just those rows. When testing, a row is dropped
+            # as soon as it emits EOS, so the remaining steps only run on unfinished sequences.
+            rows = torch.arange(bs, device=self._device)
+            step_memory, step_memory_kv = memory, memory_kv
+            # Logits of a dropped row at the remaining positions: EOS only
+            eos_logits = torch.full((1, 1, self.head.out_features), float('-inf'), device=self._device)
+            eos_logits[..., tokenizer.eos_id] = 0
             logits = []
             for i in range(num_steps):
                 j = i + 1  # next token index
                 # Efficient decoding:
-                # Input the context up to the ith token. We use only one query (at position = i) at a time.
+                # Input only the ith token. We use only one query (at position = i) at a time.
                 # This works because of the lookahead masking effect of the canonical (forward) AR context.
-                # Past tokens have no access to future tokens, hence are fixed once computed.
+                # Past tokens have no access to future tokens, hence are fixed once computed:
+                # their self-attention keys and values come from the cache.
                 tgt_out = self.decode(
-                    tgt_in[:, :j],
-                    memory,
-                    tgt_mask[:j, :j],
-                    tgt_query=pos_queries[:, i:j],
-                    tgt_query_mask=query_mask[i:j, :j],
+                    tgt_in[rows, i:j],
+                    step_memory,
+                    tgt_query=pos_queries[: len(rows), i:j],
+                    kv_cache=kv_cache,
+                    memory_kv=step_memory_kv,
                 )
                 # the next token probability is in the output's ith token position
                 p_i = self.head(tgt_out)
+                if len(rows) < bs:
+                    # Scatter back to batch order
+                    p_i = eos_logits.expand(bs, -1, -1).to(p_i.dtype).index_copy(0, rows, p_i)
                 logits.append(p_i)
                 if j < num_steps:
                     # greedy decode. add the next token index to the target input
-                    tgt_in[:, j] = p_i.squeeze().argmax(-1)
-                    # Efficient batch decoding: If all output words have at least one EOS token, end decoding.
-                    if testing and (tgt_in == tokenizer.eos_id).any(dim=-1).all():
-                        break
+                    tgt_in[rows, j] = p_i[rows, 0].argmax(-1)
+                    if testing:
+                        # Efficient batch decoding: drop the rows that have just emitted EOS and end decoding once
+                        # none is left.
+                        unfinished = tgt_in[rows, j] != tokenizer.eos_id
+                        if not unfinished.any():
+                            break
+                        if not unfinished.all():
+                            rows = rows[unfinished]
+                            step_memory = step_memory[unfinished]
+                            step_memory_kv = [(k[unfinished], v[unfinished]) for k, v in step_memory_kv]
+                            kv_cache.select(unfinished)
 
             logits = torch.cat(logits, dim=1)
         else:
             # No prior context, so input is just <bos>. We query all positions.
             tgt_in = torch.full((bs, 1), tokenizer.bos_id, dtype=torch.long, device=self._device)
-            tgt_out = self.decode(tgt_in, memory, tgt_query=pos_queries)
+            tgt_out = self.decode(tgt_in, memory, tgt_query=pos_queries, memory_kv=memory_kv)
             logits = self.head(tgt_out)
 
-        if self.refine_iters:
+        if refine_iters:
             # For iterative refinement, we always use a 'cloze' mask.
             # We can derive it from the AR forward mask by unmasking the token context to the right.
             query_mask[torch.triu(torch.ones(num_steps, num_steps, dtype=torch.bool, device=self._device), 2)] = 0
             bos = torch.full((bs, 1), tokenizer.bos_id, dtype=torch.long, device=self._device)
-            for i in range(self.refine_iters):
+            for i in range(refine_iters):
                 # Prior context is the previous output.
                 tgt_in = torch.cat([bos, logits[:, :-1].argmax(-1)], dim=1)
                 # Mask tokens beyond the first EOS token.
                 tgt_padding_mask = (tgt_in == tokenizer.eos_id).int().cumsum(-1) > 0
                 tgt_out = self.decode(
-                    tgt_in, memory, tgt_mask, tgt_padding_mask, pos_queries, query_mask[:, : tgt_in.shape[1]]
+                    tgt_in,
+                    memory,
+                    tgt_mask,
+                    tgt_padding_mask,
+                    pos_queries,
+                    query_mask[:, : tgt_in.shape[1]],
+                    memory_kv=memory_kv,
                 )
                 logits = self.head(tgt_out)
 
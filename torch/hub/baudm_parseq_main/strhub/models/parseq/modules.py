@@ -14,7 +14,7 @@
 # limitations under the License.
 
 import math
-from typing import Optional
+from typing import List, Optional, Tuple
 
 import torch
 from torch import Tensor, nn as nn
@@ -24,14 +24,120 @@ from torch.nn.modules import transformer
 from timm.models.vision_transformer import PatchEmbed, VisionTransformer
 
 
+class KVCache:
+    """Self-attention keys and values of the content stream, for every decoder layer and every position decoded so far.
+    Used for incremental AR decoding, where each step only feeds the newest position to the decoder."""
+
+    def __init__(self, num_layers: int, batch_size: int, num_heads: int, max_length: int, head_dim: int, like: Tensor):
+        shape = (num_layers, batch_size, num_heads, max_length, head_dim)
+        self.keys = like.new_empty(shape)
+        self.values = like.new_empty(shape)
+        # Number of positions already stored by all layers
+        self.length = 0
+
+    def update(self, layer: int, key: Tensor, value: Tensor):
+        """Store the keys and values (N, nhead, L, head_dim) of the new positions of a layer.
+        Returns the keys and values of all positions of that layer, new ones included."""
+        end = self.length + key.shape[2]
+        self.keys[layer, :, :, self.length : end] = key
+        self.values[layer, :, :, self.length : end] = value
+        return self.keys[layer, :, :, :end], self.values[layer, :, :, :end]
+
+    def select(self, index: Tensor):
+        """Keep only the batch rows selected by index (a boolean mask or indices), e.g. to drop finished sequences."""
+        self.keys = self.keys[:, index]
+        self.values = self.values[:, index]
+
+
+class MultiheadAttention(nn.Module):
+    """Batch-first multi-head attention built on F.scaled_dot_product_attention.
+    It has the same parameters as nn.MultiheadAttention(embed_dim, num_heads, batch_first=True), so existing checkpoints
+    load unchanged, but it only computes the attention weights when need_weights=True (e.g. for debugging).
+    Masks are boolean, and as in nn.MultiheadAttention, True means that the key may not be attended to."""
+
+    def __init__(self, embed_dim: int, num_heads: int, dropout: float = 0.0):
+        super().__init__()
+        self.embed_dim = embed_dim
+        self.num_heads = num_heads
+        self.head_dim = embed_dim // num_heads
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * embed_dim, embed_dim))
+        self.in_proj_bias = nn.Parameter(torch.empty(3 * embed_dim))
+        self.out_proj = nn.Linear(embed_dim, embed_dim)
+        # Same initialization as nn.MultiheadAttention
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.in_proj_bias)
+        nn.init.zeros_(self.out_proj.bias)
+
+    def _split_heads(self, x: Tensor):
+        N, L, _ = x.shape
+        return x.view(N, L, self.num_heads, self.head_dim).transpose(1, 2)
+
+    def project_kv(self, key: Tensor, value: Optional[Tensor] = None):
+        """Project key and value (by default the same tensor) and split them into heads: (N, nhead, S, head_dim) each.
+        The result can be reused by attend() for any number of queries."""
+        E = self.embed_dim
+        if value is None or value is key:
+            key, value = F.linear(key, self.in_proj_weight[E:], self.in_proj_bias[E:]).chunk(2, -1)
+        else:
+            key = F.linear(key, self.in_proj_weight[E : 2 * E], self.in_proj_bias[E : 2 * E])
+            value = F.linear(value, self.in_proj_weight[2 * E :], self.in_proj_bias[2 * E :])
+        return self._split_heads(key), self._split_heads(value)
+
+    def attend(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        attn_mask: Optional[Tensor] = None,
+        need_weights: bool = False,
+    ):
+        """Attention of query (N, L, E) to keys and values from project_kv().
+        attn_mask is boolean and broadcastable to (N, nhead, L, S).
+        Returns the output (N, L, E) and, only if need_weights, the weights averaged over heads (N, L, S)."""
+        E = self.embed_dim
+        q = self._split_heads(F.linear(query, self.in_proj_weight[:E], self.in_proj_bias[:E]))
+        dropout_p = self.dropout if self.training else 0.0
+        weights = None
+        if need_weights:
+            scores = q @ key.transpose(-2, -1) / math.sqrt(self.head_dim)
+            if attn_mask is not None:
+                scores = scores.masked_fill(attn_mask, float('-inf'))
+            weights = scores.softmax(-1)
+            out = F.dropout(weights, dropout_p) @ value
+            weights = weights.mean(1)
+        else:
+            # scaled_dot_product_attention takes the opposite convention: True means that the key takes part
+            attn_mask = None if attn_mask is None else ~attn_mask
+            out = F.scaled_dot_product_attention(q, key, value, attn_mask=attn_mask, dropout_p=dropout_p)
+        out = out.transpose(1, 2).reshape(query.shape)
+        return self.out_proj(out), weights
+
+    def forward(
+        self,
+        query: Tensor,
+        key: Tensor,
+        value: Tensor,
+        attn_mask: Optional[Tensor] = None,
+        key_padding_mask: Optional[Tensor] = None,
+        need_weights: bool = False,
+    ):
+        """Same interface as nn.MultiheadAttention (batch first), with boolean attn_mask (L, S) and
+        key_padding_mask (N, S). Returns (output, weights), where weights is None unless need_weights."""
+        if key_padding_mask is not None:
+            key_padding_mask = key_padding_mask[:, None, None, :]
+            attn_mask = key_padding_mask if attn_mask is None else attn_mask | key_padding_mask
+        return self.attend(query, *self.project_kv(key, value), attn_mask, need_weights)
+
+
 class DecoderLayer(nn.Module):
     """A Transformer decoder layer supporting two-stream attention (XLNet)
     This implements a pre-LN decoder, as opposed to the post-LN default in PyTorch."""
 
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1, activation='gelu', layer_norm_eps=1e-5):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout, batch_first=True)
-        self.cross_attn = nn.MultiheadAttention(d_model, nhead, dropout=dropout, batch_first=True)
+        self.self_attn = MultiheadAttention(d_model, nhead, dropout=dropout)
+        self.cross_attn = MultiheadAttention(d_model, nhead, dropout=dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(d_model, dim_feedforward)
         self.dropout = nn.Dropout(dropout)
@@ -47,6 +153,14 @@ class DecoderLayer(nn.Module):
 
         self.activation = transformer._get_activation_fn(activation)
 
+    def self_attn_kv(self, tgt_kv: Tensor):
+        """Project tgt_kv into the keys and values of self_attn, split into heads: (N, nhead, L, head_dim) each."""
+        return self.self_attn.project_kv(tgt_kv)
+
+    def cross_attn_kv(self, memory: Tensor):
+        """Project memory into the keys and values of cross_attn, split into heads: (N, nhead, S, head_dim) each."""
+        return self.cross_attn.project_kv(memory)
+
     def __setstate__(self, state):
         if 'activation' not in state:
             state['activation'] = F.gelu
@@ -60,18 +174,36 @@ class DecoderLayer(nn.Module):
         memory: Tensor,
         tgt_mask: Optional[Tensor],
         tgt_key_padding_mask: Optional[Tensor],
+        self_kv: Optional[Tuple[Tensor, Tensor]] = None,
+        memory_kv: Optional[Tuple[Tensor, Tensor]] = None,
+        need_weights: bool = False,
     ):
         """Forward pass for a single stream (i.e. content or query)
         tgt_norm is just a LayerNorm'd tgt. Added as a separate parameter for efficiency.
         Both tgt_kv and memory are expected to be LayerNorm'd too.
         memory is LayerNorm'd by ViT.
+        self_kv optionally holds the already projected self-attention keys and values (see KVCache), which are then
+        used instead of tgt_kv, unmasked. Likewise, memory_kv optionally holds the cross-attention keys and values of
+        memory (see cross_attn_kv()), which are then used instead of memory.
+        sa_weights and ca_weights are None unless need_weights.
         """
-        tgt2, sa_weights = self.self_attn(
-            tgt_norm, tgt_kv, tgt_kv, attn_mask=tgt_mask, key_padding_mask=tgt_key_padding_mask
-        )
+        if self_kv is not None:
+            tgt2, sa_weights = self.self_attn.attend(tgt_norm, *self_kv, need_weights=need_weights)
+        else:
+            tgt2, sa_weights = self.self_attn(
+                tgt_norm,
+                tgt_kv,
+                tgt_kv,
+                attn_mask=tgt_mask,
+                key_padding_mask=tgt_key_padding_mask,
+                need_weights=need_weights,
+            )
         tgt = tgt + self.dropout1(tgt2)
 
-        tgt2, ca_weights = self.cross_attn(self.norm1(tgt), memory, memory)
+        if memory_kv is not None:
+            tgt2, ca_weights = self.cross_attn.attend(self.norm1(tgt), *memory_kv, need_weights=need_weights)
+        else:
+            tgt2, ca_weights = self.cross_attn(self.norm1(tgt), memory, memory, need_weights=need_weights)
         tgt = tgt + self.dropout2(tgt2)
 
         tgt2 = self.linear2(self.dropout(self.activation(self.linear1(self.norm2(tgt)))))
@@ -87,13 +219,29 @@ class DecoderLayer(nn.Module):
         content_mask: Optional[Tensor] = None,
         content_key_padding_mask: Optional[Tensor] = None,
         update_content: bool = True,
+        kv_cache: Optional[KVCache] = None,
+        layer: int = 0,
+        memory_kv: Optional[Tuple[Tensor, Tensor]] = None,
     ):
+        """With kv_cache, content holds only the positions after the cached ones (this layer's entry, see KVCache)
+        and both streams attend to all cached positions plus the new ones; the masks are not used.
+        memory_kv optionally holds this layer's projection of memory, see Decoder.memory_kv()."""
         query_norm = self.norm_q(query)
         content_norm = self.norm_c(content)
-        query = self.forward_stream(query, query_norm, content_norm, memory, query_mask, content_key_padding_mask)[0]
+        self_kv = None if kv_cache is None else kv_cache.update(layer, *self.self_attn_kv(content_norm))
+        query = self.forward_stream(
+            query, query_norm, content_norm, memory, query_mask, content_key_padding_mask, self_kv, memory_kv
+        )[0]
         if update_content:
             content = self.forward_stream(
-                content, content_norm, content_norm, memory, content_mask, content_key_padding_mask
+                content,
+                content_norm,
+                content_norm,
+                memory,
+                content_mask,
+                content_key_padding_mask,
+                self_kv,
+                memory_kv,
             )[0]
         return query, content
 
@@ -115,15 +263,38 @@ class Decoder(nn.Module):
         query_mask: Optional[Tensor] = None,
         content_mask: Optional[Tensor] = None,
         content_key_padding_mask: Optional[Tensor] = None,
+        kv_cache: Optional[KVCache] = None,
+        memory_kv: Optional[List[Tuple[Tensor, Tensor]]] = None,
     ):
         for i, mod in enumerate(self.layers):
             last = i == len(self.layers) - 1
             query, content = mod(
-                query, content, memory, query_mask, content_mask, content_key_padding_mask, update_content=not last
+                query,
+                content,
+                memory,
+                query_mask,
+                content_mask,
+                content_key_padding_mask,
+                update_content=not last,
+                kv_cache=kv_cache,
+                layer=i,
+                memory_kv=None if memory_kv is None else memory_kv[i],
             )
+        if kv_cache is not None:
+            kv_cache.length += content.shape[1]
         query = self.norm(query)
         return query
 
+    def memory_kv(self, memory: Tensor) -> List[Tuple[Tensor, Tensor]]:
+        """The cross-attention keys and values of memory for every layer. They only depend on the image, so they can be
+        computed once and passed to every decoder call of a forward pass."""
+        return [mod.cross_attn_kv(memory) for mod in self.layers]
+
+    def kv_cache(self, batch_size: int, max_length: int, like: Tensor) -> KVCache:
+        """An empty KVCache for up to max_length positions, with the dtype and device of like."""
+        attn = self.layers[0].self_attn
+        return KVCache(self.num_layers, batch_size, attn.num_heads, max_length, attn.head_dim, like)
+
 
 class Encoder(VisionTransformer):
 
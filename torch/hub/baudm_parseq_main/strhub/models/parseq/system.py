@@ -84,8 +84,14 @@ class PARSeq(CrossEntropySystem):
         self.perm_forward = perm_forward
         self.perm_mirrored = perm_mirrored
 
-    def forward(self, images: Tensor, max_length: Optional[int] = None) -> Tensor:
-        return self.model.forward(self.tokenizer, images, max_length)
+    def forward(
+        self,
+        images: Tensor,
+        max_length: Optional[int] = None,
+        decode_ar: Optional[bool] = None,
+        refine_iters: Optional[int] = None,
+    ) -> Tensor:
+        return self.model.forward(self.tokenizer, images, max_length, decode_ar, refine_iters)
 
     def gen_tgt_perms(self, tgt):
         """Generate shared permutations for the whole batch.
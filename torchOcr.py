@@ -1,26 +1,73 @@
 import os
+import threading
 import torch
-from torchvision import transforms as T
 from PIL import Image, ImageEnhance
 from io import BytesIO
+import numpy as np
+
+import metrics
+from artifact import experiment_name, import_inference, load_artifact
+from autotune import apply_tuning
+from adjust import adjust_batch
 
 MODEL_PATH = '/var/task/torch/hub/baudm_parseq_main'
+# hubconf entry points preloaded by this process. The first one serves requests that do not choose a model
+MODEL_VARIANTS = [v.strip() for v in os.environ.get('OCR_MODEL_VARIANTS', 'parseq').split(',') if v.strip()]
+MODEL_VARIANT = MODEL_VARIANTS[0]
+# Prebuilt inference artifact of each variant (see artifact.py), used instead of building the model from its
+# configs when it exists
+ARTIFACT_PATH = os.environ.get('OCR_ARTIFACT_PATH', '/var/task/{variant}.artifact.pt')
+# Name under which MODEL_VARIANTS can include the parseq_tiny -> parseq cascade, see cascade.py
+CASCADE_VARIANT = 'cascade'
+# Upper bound on the refinement iterations a request can ask for
+MAX_REFINE_ITERS = int(os.environ.get('OCR_MAX_REFINE_ITERS', 3))
+
+# Process-wide model handles by variant, see get_ocr_model()
+_ocr_models = {}
+_ocr_model_lock = threading.RLock()
+
 class OCRModel:
-    def __init__(self):
+    def __init__(self, variant=MODEL_VARIANT, tune=True):
+        # Apply the thread configuration saved by autotune.py, if any
+        self.tuning = apply_tuning() if tune else None
+
         # Load the model
         print(MODEL_PATH)
-        self.model = torch.hub.load(MODEL_PATH, 'parseq', source='local', pretrained=True, trust_repo=True).eval()
+        self.variant = variant
+        # Only PARSeq takes per-call decode_ar and refine_iters
+        self.is_parseq = variant.startswith('parseq')
+        artifact_path = ARTIFACT_PATH.format(variant=variant)
+        if self.is_parseq and os.path.exists(artifact_path):
+            self.model = load_artifact(MODEL_PATH, artifact_path)
+            if self.model.hparams.variant != self.variant:
+                raise RuntimeError(f"{artifact_path} holds '{self.model.hparams.variant}', expected '{self.variant}'")
+        elif self.is_parseq:
+            # Inference-only model: no pytorch_lightning, nltk or optimizer imports
+            inference = import_inference(MODEL_PATH)
+            self.model = inference.create_inference_model(experiment_name(self.variant), pretrained=True)
+            self.model.hparams.variant = self.variant
+        else:
+            # The other hubconf models (abinet, crnn, trba, vitstr) only exist as LightningModules
+            self.model = torch.hub.load(MODEL_PATH, variant, source='local', pretrained=True).eval()
+        self.img_size = tuple(self.model.hparams.img_size)
+        if self.is_parseq:
+            metrics.instrument_model(self.model)
 
-        # Preprocess transformation
-        self._preprocess = T.Compose([
-            T.Resize((32, 128), T.InterpolationMode.BICUBIC),
-            T.ToTensor(),
-            T.Normalize(0.5, 0.5)
-        ])
+    def warmup(self):
+        """
+        Run one dummy forward per decode length so the first real request does not pay for lazy initialization.
+        """
+        height, width = self.img_size
+        dummy = torch.zeros(1, 3, height, width)
+        with torch.no_grad(), metrics.paused():
+            self.model(dummy)
+            for max_length in range(1, self.model.hparams.max_label_length + 1):
+                self.model(dummy, max_length)
 
     def adjust_image(self, image, brightness=1.0, contrast=1.0, sharpness=1.0):
         """
         Adjust the brightness, contrast, and sharpness of the image.
+        This is the PIL reference for imaging.adjust_batch, which is what load_images uses.
         """
         enhancer = ImageEnhance.Brightness(image)
         image = enhancer.enhance(brightness)
@@ -33,27 +80,138 @@ class OCRModel:
 
         return image
 
-    def predict(self, image_input, brightness=1.0, contrast=1.0, sharpness=1.0):
+    def decode_image(self, image_input):
         """
-        Predict text from an image. The image can be provided as a file path or a buffer.
+        Decode an image from a file path, bytes or a buffer into an (H, W, 3) uint8 RGB array.
         """
-        if isinstance(image_input, bytes):
-            image = Image.open(BytesIO(image_input)).convert('RGB')
-        else:
-            image = Image.open(image_input).convert('RGB')
+        with metrics.timed('bytes_decode'):
+            if isinstance(image_input, bytes):
+                image = Image.open(BytesIO(image_input)).convert('RGB')
+            else:
+                image = Image.open(image_input).convert('RGB')
+            return np.asarray(image)
 
-        # Adjust the image according to user-defined values
-        image = self.adjust_image(image, brightness, contrast, sharpness)
-        # Preprocess the image
-        image = self._preprocess(image).unsqueeze(0)
+    def load_images(self, images, brightness, contrast, sharpness):
+        """
+        Adjust a list of decoded images, each with its own brightness, contrast and sharpness factor,
+        and turn them into a batch of model input tensors (N, C, H, W) in one vectorized pass.
+        """
+        with metrics.timed('tensor_preprocess'):
+            return adjust_batch(images, brightness, contrast, sharpness, self.img_size)
+
+    def load_image(self, image_input, brightness=1.0, contrast=1.0, sharpness=1.0):
+        """
+        Load an image from a file path, bytes or a buffer and turn it into a model input tensor (C, H, W).
+        """
+        image = self.decode_image(image_input)
+        return self.load_images([image], [brightness], [contrast], [sharpness])[0]
 
-        # Perform inference
+    def predict_scores(self, images, max_length=None, **settings):
+        """
+        Like predict_batch(), but each result also holds the unrounded sequence confidence: the product of the
+        probabilities of every character and of <eos>.
+        """
+        if isinstance(images, (list, tuple)):
+            images = torch.stack(images)
+        metrics.batch_size.observe(len(images))
         with torch.no_grad():
-            pred = self.model(image).softmax(-1)
-            label, _ = self.model.tokenizer.decode(pred)
-            tensor_values = torch.tensor(_[0])
-            confidenceScore = round(tensor_values[-1].item(), 3)
-            print(_[0])
-
-        
-        return label[0], confidenceScore
+            pred = self.model(images, max_length, **settings).softmax(-1)
+            with metrics.timed('tokenizer_decode'):
+                labels, probs = self.model.tokenizer.decode(pred)
+
+        return [(label, round(prob[-1].item(), 3), prob.prod().item()) for label, prob in zip(labels, probs)]
+
+    def predict_batch(self, images, max_length=None, **settings):
+        """
+        Predict text for a batch of preprocessed images in a single forward pass.
+        The batch can be a (N, C, H, W) tensor or a list of (C, H, W) tensors.
+        settings are per-call decode_ar and refine_iters overrides, see decode_options().
+        Returns a list of (detected_text, confidence_score) tuples in batch order.
+        """
+        return [(label, confidence) for label, confidence, _ in self.predict_scores(images, max_length, **settings)]
+
+    def predict(self, image_input, brightness=1.0, contrast=1.0, sharpness=1.0, **settings):
+        """
+        Predict text from an image. The image can be provided as a file path or a buffer.
+        """
+        image = self.load_image(image_input, brightness, contrast, sharpness)
+        return self.predict_batch(image.unsqueeze(0), **settings)[0]
+
+
+def get_ocr_model(variant=None, warmup=True, tune=True):
+    """
+    Return the shared OCRModel of a variant (by default MODEL_VARIANT) for this process, loading and warming it up
+    on first use. The model is only read during inference, so the same handle can be used from multiple threads.
+    A pre-fork master passes warmup=False and tune=False and leaves both to each worker.
+    """
+    variant = variant or MODEL_VARIANT
+    if variant not in _ocr_models:
+        with _ocr_model_lock:
+            if variant not in _ocr_models:
+                if variant == CASCADE_VARIANT:
+                    # Built from the (shared) models of its two stages
+                    from cascade import CascadeModel
+                    ocr_model = CascadeModel(tune=tune)
+                else:
+                    ocr_model = OCRModel(variant, tune)
+                if warmup:
+                    ocr_model.warmup()
+                _ocr_models[variant] = ocr_model
+    return _ocr_models[variant]
+
+
+def load_models(warmup=True, tune=True):
+    """
+    Preload every variant in MODEL_VARIANTS.
+    """
+    return [get_ocr_model(variant, warmup, tune) for variant in MODEL_VARIANTS]
+
+
+def prediction_fields(prediction):
+    """
+    Response fields of one predict_batch() result. Cascade results also name the stage that produced them.
+    """
+    fields = {"detected_text": prediction[0], "confidence_score": prediction[1]}
+    if len(prediction) > 2:
+        fields["stage"] = prediction[2]
+    return fields
+
+
+def _parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    value = str(value).strip().lower()
+    if value in ('1', 'true', 'yes', 'on'):
+        return True
+    if value in ('0', 'false', 'no', 'off'):
+        return False
+    raise ValueError(f"Invalid boolean value: {value}")
+
+
+def decode_options(values):
+    """
+    The model variant and per-call decode settings chosen by a request, from its 'model', 'decodeAr', 'refineIters'
+    and 'maxLength' fields (a JSON object, form or query string). Returns (variant, settings), where settings
+    holds the decode_ar, refine_iters and max_length keyword arguments of predict_batch() that were given.
+    Raises ValueError for an unknown variant or an invalid setting.
+    """
+    variant = values.get('model') or MODEL_VARIANT
+    if variant not in MODEL_VARIANTS:
+        raise ValueError(f"Unknown model '{variant}', expected one of: {', '.join(MODEL_VARIANTS)}")
+
+    settings = {}
+    if values.get('decodeAr') is not None:
+        settings['decode_ar'] = _parse_bool(values.get('decodeAr'))
+    if values.get('refineIters') is not None:
+        settings['refine_iters'] = int(values.get('refineIters'))
+        if not 0 <= settings['refine_iters'] <= MAX_REFINE_ITERS:
+            raise ValueError(f"refineIters must be between 0 and {MAX_REFINE_ITERS}")
+    if values.get('maxLength') is not None:
+        settings['max_length'] = int(values.get('maxLength'))
+        if settings['max_length'] < 1:
+            raise ValueError("maxLength must be at least 1")
+    if variant == CASCADE_VARIANT and ('decode_ar' in settings or 'refine_iters' in settings):
+        raise ValueError("The cascade decodes with the settings of its stages, only maxLength can be given")
+    if not variant.startswith('parseq') and ('decode_ar' in settings or 'refine_iters' in settings):
+        raise ValueError(f"decodeAr and refineIters only apply to the parseq models, not '{variant}'")
+    return variant, settings